@@ -1,11 +1,11 @@
 import json
 import logging
 import re
-import threading
 import time
-from typing import List
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
 
-import requests
 from openai import APITimeoutError
 from slack_bolt import App, Ack, BoltContext, BoltResponse
 from slack_bolt.request.payload_utils import is_event
@@ -17,6 +17,9 @@ from app.env import (
     SYSTEM_TEXT,
     TRANSLATE_MARKDOWN,
     OPENAI_IMAGE_GENERATION_MODEL,
+    REPLY_DEBOUNCE_MS,
+    SLACK_API_MAX_WORKERS,
+    IMAGE_IO_MAX_WORKERS,
 )
 from app.i18n import translate
 from app.openai_image_ops import (
@@ -36,13 +39,20 @@ from app.openai_ops import (
 )
 from app.slack_constants import DEFAULT_LOADING_TEXT, TIMEOUT_ERROR_MESSAGE
 from app.slack_ops import (
-    find_parent_message,
-    is_this_app_mentioned,
+    fetch_thread_replies,
+    forget_changed_thread_message,
+    is_this_app_thread,
+    remember_this_app_thread,
     post_wip_message,
     update_wip_message,
+    remember_latest_message_ts,
+    is_newer_message_received,
     extract_state_value,
     build_thread_replies_as_combined_text,
     can_send_image_url_to_openai,
+    download_file_content,
+    open_dm,
+    wait_until_file_is_shared,
 )
 
 from app.sensitive_info_redaction import redact_string
@@ -77,6 +87,15 @@ from app.slack_ui import (
 )
 
 
+# Runs Slack API calls and other I/O that can be done while waiting for something else
+slack_api_executor = ThreadPoolExecutor(
+    max_workers=SLACK_API_MAX_WORKERS, thread_name_prefix="slack-api-calls"
+)
+# Downloads and generates images; the number of parallel OpenAI image requests is bounded
+image_io_executor = ThreadPoolExecutor(
+    max_workers=IMAGE_IO_MAX_WORKERS, thread_name_prefix="image-io"
+)
+
 #
 # Listener functions
 #
@@ -91,6 +110,73 @@ def just_ack(ack: Ack):
 #
 
 
+@lru_cache(maxsize=32)
+def _bot_mention_pattern(bot_user_id: str) -> re.Pattern:
+    return re.compile(f"<@{bot_user_id}>\\s*")
+
+
+def _append_error_to_wip_reply(
+    *, client: WebClient, channel: str, wip_reply: dict, error: str
+) -> None:
+    base_text = wip_reply["message"].get("text", "")
+    client.chat_update(
+        channel=channel,
+        ts=wip_reply["message"]["ts"],
+        text=f"{base_text}\n\n{error}",
+    )
+
+
+def _is_newer_reply_posted(
+    *, client: WebClient, channel: str, wip_reply_future: Future
+) -> bool:
+    # The executor runs tasks in order, so posting the loading message
+    # has already started when this task runs
+    wip_reply = wip_reply_future.result()
+    # This process may not receive all the events (e.g., on AWS Lambda),
+    # so verify the latest reply in the thread as well
+    # Only the replies posted after the loading message matter here;
+    # the response can include the parent message in addition to them
+    latest_replies = client.conversations_replies(
+        channel=channel,
+        ts=wip_reply.get("ts"),
+        oldest=wip_reply["message"]["ts"],
+        inclusive=False,
+        limit=2,
+    )
+    return any(
+        float(reply["ts"]) > float(wip_reply["message"]["ts"])
+        for reply in latest_replies.get("messages", [])
+    )
+
+
+def build_openai_message_from_reply(
+    *,
+    context: BoltContext,
+    reply: dict,
+    msg_user_id: Optional[str],
+    can_send_image_url: bool,
+) -> dict:
+    reply_text = redact_string(reply.get("text"))
+    content = [
+        {
+            "type": "text",
+            "text": f"<@{msg_user_id}>: "
+            + format_openai_message_content(reply_text, TRANSLATE_MARKDOWN),
+        }
+    ]
+    if can_send_image_url and reply.get("bot_id") is None:
+        append_image_content_if_exists(
+            bot_token=context.bot_token,
+            files=reply.get("files"),
+            content=content,
+            logger=context.logger,
+        )
+    return {
+        "role": "assistant" if reply.get("user") == context.bot_user_id else "user",
+        "content": content,
+    }
+
+
 def respond_to_app_mention(
     context: BoltContext,
     payload: dict,
@@ -99,12 +185,17 @@ def respond_to_app_mention(
 ):
     thread_ts = payload.get("thread_ts")
     if thread_ts is not None:
-        parent_message = find_parent_message(client, context.channel_id, thread_ts)
-        if parent_message is not None and is_this_app_mentioned(
-            context, parent_message
+        if is_this_app_thread(
+            context=context,
+            client=client,
+            channel=context.channel_id,
+            thread_ts=thread_ts,
         ):
             # The message event handler will reply to this
             return
+    else:
+        # The replies in this thread will be handled by the message event handler
+        remember_this_app_thread(context, context.channel_id, payload["ts"], True)
 
     wip_reply = None
     # Replace placeholder for Slack user ID in the system prompt
@@ -121,6 +212,13 @@ def respond_to_app_mention(
             return
 
         user_id = context.actor_user_id or context.user_id
+        # Translate the loading text while fetching the thread replies
+        loading_text_future = slack_api_executor.submit(
+            translate,
+            openai_api_key=openai_api_key,
+            context=context,
+            text=DEFAULT_LOADING_TEXT,
+        )
         if thread_ts is not None:
             # Mentioning the bot user in a thread
             replies_in_thread = client.conversations_replies(
@@ -129,38 +227,21 @@ def respond_to_app_mention(
                 include_all_metadata=True,
                 limit=1000,
             ).get("messages", [])
-            for reply in replies_in_thread:
-                reply_text = redact_string(reply.get("text"))
-                message_text_item = {
-                    "type": "text",
-                    "text": f"<@{reply['user'] if 'user' in reply else reply['username']}>: "
-                    + format_openai_message_content(reply_text, TRANSLATE_MARKDOWN),
-                }
-                content = [message_text_item]
-
-                if reply.get("bot_id") is None and can_send_image_url_to_openai(
-                    context
-                ):
-                    append_image_content_if_exists(
-                        bot_token=context.bot_token,
-                        files=reply.get("files"),
-                        content=content,
-                        logger=context.logger,
-                    )
-
-                messages.append(
-                    {
-                        "role": (
-                            "assistant"
-                            if "user" in reply and reply["user"] == context.bot_user_id
-                            else "user"
-                        ),
-                        "content": content,
-                    }
+            can_send_image_url = can_send_image_url_to_openai(context)
+            messages.extend(
+                build_openai_message_from_reply(
+                    context=context,
+                    reply=reply,
+                    msg_user_id=reply["user"] if "user" in reply else reply["username"],
+                    can_send_image_url=can_send_image_url,
                 )
+                for reply in replies_in_thread
+            )
         else:
             # Strip bot Slack user ID from initial message
-            msg_text = re.sub(f"<@{context.bot_user_id}>\\s*", "", payload["text"])
+            msg_text = _bot_mention_pattern(context.bot_user_id).sub(
+                "", payload["text"]
+            )
             msg_text = redact_string(msg_text)
             message_text_item = {
                 "type": "text",
@@ -179,24 +260,43 @@ def respond_to_app_mention(
 
             messages.append({"role": "user", "content": content})
 
-        loading_text = translate(
-            openai_api_key=openai_api_key, context=context, text=DEFAULT_LOADING_TEXT
-        )
-        wip_reply = post_wip_message(
+        loading_text = loading_text_future.result()
+        # Post the loading message while sending the request to OpenAI
+        wip_reply_future = slack_api_executor.submit(
+            post_wip_message,
             client=client,
             channel=context.channel_id,
             thread_ts=payload["ts"],
             loading_text=loading_text,
-            messages=messages,
+            messages=list(messages),
             user=context.user_id,
         )
+        try:
+            (
+                messages,
+                num_context_tokens,
+                max_context_tokens,
+            ) = messages_within_context_window(messages, context=context)
+            num_messages = len([msg for msg in messages if msg.get("role") != "system"])
+            if num_messages > 0:
+                stream = start_receiving_openai_response(
+                    openai_api_key=openai_api_key,
+                    model=context["OPENAI_MODEL"],
+                    temperature=context["OPENAI_TEMPERATURE"],
+                    messages=messages,
+                    user=context.user_id,
+                    openai_api_type=context["OPENAI_API_TYPE"],
+                    openai_api_base=context["OPENAI_API_BASE"],
+                    openai_api_version=context["OPENAI_API_VERSION"],
+                    openai_deployment_id=context["OPENAI_DEPLOYMENT_ID"],
+                    openai_organization_id=context["OPENAI_ORG_ID"],
+                    function_call_module_name=context[
+                        "OPENAI_FUNCTION_CALL_MODULE_NAME"
+                    ],
+                )
+        finally:
+            wip_reply = wip_reply_future.result()
 
-        (
-            messages,
-            num_context_tokens,
-            max_context_tokens,
-        ) = messages_within_context_window(messages, context=context)
-        num_messages = len([msg for msg in messages if msg.get("role") != "system"])
         if num_messages == 0:
             update_wip_message(
                 client=client,
@@ -207,19 +307,6 @@ def respond_to_app_mention(
                 user=context.user_id,
             )
         else:
-            stream = start_receiving_openai_response(
-                openai_api_key=openai_api_key,
-                model=context["OPENAI_MODEL"],
-                temperature=context["OPENAI_TEMPERATURE"],
-                messages=messages,
-                user=context.user_id,
-                openai_api_type=context["OPENAI_API_TYPE"],
-                openai_api_base=context["OPENAI_API_BASE"],
-                openai_api_version=context["OPENAI_API_VERSION"],
-                openai_deployment_id=context["OPENAI_DEPLOYMENT_ID"],
-                openai_organization_id=context["OPENAI_ORG_ID"],
-                function_call_module_name=context["OPENAI_FUNCTION_CALL_MODULE_NAME"],
-            )
             consume_openai_stream_to_write_reply(
                 client=client,
                 wip_reply=wip_reply,
@@ -233,44 +320,30 @@ def respond_to_app_mention(
 
     except (APITimeoutError, TimeoutError):
         if wip_reply is not None:
-            text = (
-                (
-                    wip_reply.get("message", {}).get("text", "")
-                    if wip_reply is not None
-                    else ""
-                )
-                + "\n\n"
-                + translate(
+            _append_error_to_wip_reply(
+                client=client,
+                channel=context.channel_id,
+                wip_reply=wip_reply,
+                error=translate(
                     openai_api_key=openai_api_key,
                     context=context,
                     text=TIMEOUT_ERROR_MESSAGE,
-                )
-            )
-            client.chat_update(
-                channel=context.channel_id,
-                ts=wip_reply["message"]["ts"],
-                text=text,
+                ),
             )
     except Exception as e:
-        text = (
-            (
-                wip_reply.get("message", {}).get("text", "")
-                if wip_reply is not None
-                else ""
-            )
-            + "\n\n"
-            + translate(
+        logger.exception(f"Failed to start a conversation with ChatGPT: {e}")
+        if wip_reply is not None:
+            # Only the constant part is translated so that the result can be cached
+            error = translate(
                 openai_api_key=openai_api_key,
                 context=context,
-                text=f":warning: Failed to start a conversation with ChatGPT: {e}",
+                text=":warning: Failed to start a conversation with ChatGPT:",
             )
-        )
-        logger.exception(text, e)
-        if wip_reply is not None:
-            client.chat_update(
+            _append_error_to_wip_reply(
+                client=client,
                 channel=context.channel_id,
-                ts=wip_reply["message"]["ts"],
-                text=text,
+                wip_reply=wip_reply,
+                error=f"{error} {e}",
             )
 
 
@@ -280,7 +353,8 @@ def respond_to_new_message(
     client: WebClient,
     logger: logging.Logger,
 ):
-    if payload.get("bot_id") is not None and payload.get("bot_id") != context.bot_id:
+    bot_id = payload.get("bot_id")
+    if bot_id is not None and bot_id != context.bot_id:
         # Skip a new message by a different app
         return
 
@@ -288,154 +362,164 @@ def respond_to_new_message(
     if openai_api_key is None:
         return
 
+    is_in_dm_with_bot = payload.get("channel_type") == "im"
+    thread_ts = payload.get("thread_ts")
+    if is_in_dm_with_bot is False and thread_ts is None:
+        return
+
     wip_reply = None
     try:
-        is_in_dm_with_bot = payload.get("channel_type") == "im"
         is_thread_for_this_app = False
-        thread_ts = payload.get("thread_ts")
-        if is_in_dm_with_bot is False and thread_ts is None:
+        remember_latest_message_ts(context.channel_id, thread_ts, payload["ts"])
+
+        if is_in_dm_with_bot is True:
+            # In the DM with this bot
+            is_thread_for_this_app = True
+        else:
+            # In a channel; check the parent message before fetching the whole thread
+            is_thread_for_this_app = is_this_app_thread(
+                context=context,
+                client=client,
+                channel=context.channel_id,
+                thread_ts=thread_ts,
+            )
+        if is_thread_for_this_app is False:
             return
 
-        messages_in_context = []
+        if REPLY_DEBOUNCE_MS > 0:
+            time.sleep(REPLY_DEBOUNCE_MS / 1000)
+            if is_newer_message_received(context.channel_id, thread_ts, payload["ts"]):
+                # Only the latest message in a burst of messages gets a reply
+                return
+
+        # Translate the loading text while fetching the conversation history
+        loading_text_future = slack_api_executor.submit(
+            translate,
+            openai_api_key=openai_api_key,
+            context=context,
+            text=DEFAULT_LOADING_TEXT,
+        )
         if is_in_dm_with_bot is True and thread_ts is None:
             # In the DM with the bot; this is not within a thread
-            past_messages = client.conversations_history(
+            # Slack returns only the messages posted within the last day
+            messages_in_context = client.conversations_history(
                 channel=context.channel_id,
+                oldest=str(time.time() - 86400),
                 include_all_metadata=True,
                 limit=100,
             ).get("messages", [])
-            past_messages.reverse()
-            # Remove old messages
-            for message in past_messages:
-                seconds = time.time() - float(message.get("ts"))
-                if seconds < 86400:  # less than 1 day
-                    messages_in_context.append(message)
-            is_thread_for_this_app = True
+            messages_in_context.reverse()
         else:
             # Within a thread
-            messages_in_context = client.conversations_replies(
+            messages_in_context = fetch_thread_replies(
+                client=client,
                 channel=context.channel_id,
-                ts=thread_ts,
-                include_all_metadata=True,
-                limit=1000,
-            ).get("messages", [])
-            if is_in_dm_with_bot is True:
-                # In the DM with this bot
-                is_thread_for_this_app = True
-            else:
-                # In a channel
-                the_parent_message_found = False
-                for message in messages_in_context:
-                    if message.get("ts") == thread_ts:
-                        the_parent_message_found = True
-                        is_thread_for_this_app = is_this_app_mentioned(context, message)
-                        break
-                if the_parent_message_found is False:
-                    parent_message = find_parent_message(
-                        client, context.channel_id, thread_ts
-                    )
-                    if parent_message is not None:
-                        is_thread_for_this_app = is_this_app_mentioned(
-                            context, parent_message
-                        )
-
-        if is_thread_for_this_app is False:
-            return
+                thread_ts=thread_ts,
+            )
 
         messages = []
         user_id = context.actor_user_id or context.user_id
         last_assistant_idx = -1
-        indices_to_remove = []
+        can_send_image_url = can_send_image_url_to_openai(context)
+        # The replies in the thread converted to OpenAI messages
+        messages_from_replies = []
+        # The replies can be shared with the thread replies cache; never modify them
         for idx, reply in enumerate(messages_in_context):
-            maybe_event_type = reply.get("metadata", {}).get("event_type")
-            if maybe_event_type == "chat-gpt-convo":
+            # Strip bot Slack user ID from initial message
+            if idx == 0:
+                reply = {
+                    **reply,
+                    "text": _bot_mention_pattern(context.bot_user_id).sub(
+                        "", reply["text"]
+                    ),
+                }
+            metadata = reply.get("metadata")
+            if metadata is not None and metadata.get("event_type") == "chat-gpt-convo":
                 if context.bot_id != reply.get("bot_id"):
                     # Remove messages by a different app
-                    indices_to_remove.append(idx)
                     continue
-                maybe_new_messages = (
-                    reply.get("metadata", {}).get("event_payload", {}).get("messages")
-                )
+                event_payload = metadata.get("event_payload") or {}
+                maybe_new_messages = event_payload.get("messages")
                 if maybe_new_messages is not None:
                     if len(messages) == 0 or user_id is None:
-                        new_user_id = (
-                            reply.get("metadata", {})
-                            .get("event_payload", {})
-                            .get("user")
-                        )
+                        new_user_id = event_payload.get("user")
                         if new_user_id is not None:
                             user_id = new_user_id
-                    messages = maybe_new_messages
-                    last_assistant_idx = idx
+                    messages = list(maybe_new_messages)
+                    last_assistant_idx = len(messages_from_replies)
+            messages_from_replies.append(
+                build_openai_message_from_reply(
+                    context=context,
+                    reply=reply,
+                    msg_user_id=reply.get("user"),
+                    can_send_image_url=can_send_image_url,
+                )
+            )
 
         if is_in_dm_with_bot is True or last_assistant_idx == -1:
             # To know whether this app needs to start a new convo
-            if not next(filter(lambda msg: msg["role"] == "system", messages), None):
+            # The system message is always the first one when it exists
+            if len(messages) == 0 or messages[0]["role"] != "system":
                 # Replace placeholder for Slack user ID in the system prompt
                 system_text = build_system_text(
                     SYSTEM_TEXT, TRANSLATE_MARKDOWN, context
                 )
                 messages.insert(0, {"role": "system", "content": system_text})
 
-        filtered_messages_in_context = []
-        for idx, reply in enumerate(messages_in_context):
-            # Strip bot Slack user ID from initial message
-            if idx == 0:
-                reply["text"] = re.sub(
-                    f"<@{context.bot_user_id}>\\s*", "", reply["text"]
-                )
-            if idx not in indices_to_remove:
-                filtered_messages_in_context.append(reply)
-        if len(filtered_messages_in_context) == 0:
+        if len(messages_from_replies) == 0:
             return
 
-        for reply in filtered_messages_in_context:
-            msg_user_id = reply.get("user")
-            reply_text = redact_string(reply.get("text"))
-            content = [
-                {
-                    "type": "text",
-                    "text": f"<@{msg_user_id}>: "
-                    + format_openai_message_content(reply_text, TRANSLATE_MARKDOWN),
-                }
-            ]
-            if reply.get("bot_id") is None and can_send_image_url_to_openai(context):
-                append_image_content_if_exists(
-                    bot_token=context.bot_token,
-                    files=reply.get("files"),
-                    content=content,
-                    logger=context.logger,
-                )
+        messages.extend(messages_from_replies)
 
-            messages.append(
-                {
-                    "content": content,
-                    "role": (
-                        "assistant"
-                        if "user" in reply and reply["user"] == context.bot_user_id
-                        else "user"
-                    ),
-                }
-            )
+        if is_newer_message_received(context.channel_id, thread_ts, payload["ts"]):
+            # A newer message arrived while fetching the conversation;
+            # skip both the loading message and the OpenAI request
+            return
 
-        loading_text = translate(
-            openai_api_key=openai_api_key, context=context, text=DEFAULT_LOADING_TEXT
-        )
-        wip_reply = post_wip_message(
+        loading_text = loading_text_future.result()
+        # Post the loading message while sending the request to OpenAI
+        wip_reply_future = slack_api_executor.submit(
+            post_wip_message,
             client=client,
             channel=context.channel_id,
             thread_ts=payload.get("thread_ts") if is_in_dm_with_bot else payload["ts"],
             loading_text=loading_text,
-            messages=messages,
+            messages=list(messages),
             user=user_id,
         )
+        try:
+            (
+                messages,
+                num_context_tokens,
+                max_context_tokens,
+            ) = messages_within_context_window(messages, context=context)
+            num_messages = len([msg for msg in messages if msg.get("role") != "system"])
+            if num_messages > 0:
+                # Check the latest replies in the thread while starting the request to OpenAI
+                newer_reply_future = slack_api_executor.submit(
+                    _is_newer_reply_posted,
+                    client=client,
+                    channel=context.channel_id,
+                    wip_reply_future=wip_reply_future,
+                )
+                stream = start_receiving_openai_response(
+                    openai_api_key=openai_api_key,
+                    model=context["OPENAI_MODEL"],
+                    temperature=context["OPENAI_TEMPERATURE"],
+                    messages=messages,
+                    user=user_id,
+                    openai_api_type=context["OPENAI_API_TYPE"],
+                    openai_api_base=context["OPENAI_API_BASE"],
+                    openai_api_version=context["OPENAI_API_VERSION"],
+                    openai_deployment_id=context["OPENAI_DEPLOYMENT_ID"],
+                    openai_organization_id=context["OPENAI_ORG_ID"],
+                    function_call_module_name=context[
+                        "OPENAI_FUNCTION_CALL_MODULE_NAME"
+                    ],
+                )
+        finally:
+            wip_reply = wip_reply_future.result()
 
-        (
-            messages,
-            num_context_tokens,
-            max_context_tokens,
-        ) = messages_within_context_window(messages, context=context)
-        num_messages = len([msg for msg in messages if msg.get("role") != "system"])
         if num_messages == 0:
             update_wip_message(
                 client=client,
@@ -446,31 +530,12 @@ def respond_to_new_message(
                 user=context.user_id,
             )
         else:
-            stream = start_receiving_openai_response(
-                openai_api_key=openai_api_key,
-                model=context["OPENAI_MODEL"],
-                temperature=context["OPENAI_TEMPERATURE"],
-                messages=messages,
-                user=user_id,
-                openai_api_type=context["OPENAI_API_TYPE"],
-                openai_api_base=context["OPENAI_API_BASE"],
-                openai_api_version=context["OPENAI_API_VERSION"],
-                openai_deployment_id=context["OPENAI_DEPLOYMENT_ID"],
-                openai_organization_id=context["OPENAI_ORG_ID"],
-                function_call_module_name=context["OPENAI_FUNCTION_CALL_MODULE_NAME"],
-            )
-
-            latest_replies = client.conversations_replies(
-                channel=context.channel_id,
-                ts=wip_reply.get("ts"),
-                include_all_metadata=True,
-                limit=1000,
-            )
             if (
-                latest_replies.get("messages", [])[-1]["ts"]
-                != wip_reply["message"]["ts"]
+                is_newer_message_received(context.channel_id, thread_ts, payload["ts"])
+                or newer_reply_future.result()
             ):
                 # Since a new reply will come soon, this app abandons this reply
+                stream.close()
                 client.chat_delete(
                     channel=context.channel_id,
                     ts=wip_reply["message"]["ts"],
@@ -490,40 +555,24 @@ def respond_to_new_message(
 
     except (APITimeoutError, TimeoutError):
         if wip_reply is not None:
-            text = (
-                (
-                    wip_reply.get("message", {}).get("text", "")
-                    if wip_reply is not None
-                    else ""
-                )
-                + "\n\n"
-                + translate(
+            _append_error_to_wip_reply(
+                client=client,
+                channel=context.channel_id,
+                wip_reply=wip_reply,
+                error=translate(
                     openai_api_key=openai_api_key,
                     context=context,
                     text=TIMEOUT_ERROR_MESSAGE,
-                )
-            )
-            client.chat_update(
-                channel=context.channel_id,
-                ts=wip_reply["message"]["ts"],
-                text=text,
+                ),
             )
     except Exception as e:
-        text = (
-            (
-                wip_reply.get("message", {}).get("text", "")
-                if wip_reply is not None
-                else ""
-            )
-            + "\n\n"
-            + f":warning: Failed to reply: {e}"
-        )
-        logger.exception(text, e)
+        logger.exception(f"Failed to reply: {e}")
         if wip_reply is not None:
-            client.chat_update(
+            _append_error_to_wip_reply(
+                client=client,
                 channel=context.channel_id,
-                ts=wip_reply["message"]["ts"],
-                text=text,
+                wip_reply=wip_reply,
+                error=f":warning: Failed to reply: {e}",
             )
 
 
@@ -640,7 +689,7 @@ def ack_proofreading_modal_submission(
     context: BoltContext,
 ):
     original_text = extract_state_value(payload, "original_text").get("value")
-    text = "\n".join(map(lambda s: f">{s}", original_text.split("\n")))
+    text = ">" + original_text.replace("\n", "\n>")
     view = build_proofreading_wip_modal(
         payload=payload,
         context=context,
@@ -665,7 +714,7 @@ def display_proofreading_result(
             if tone_and_voice.get("selected_option")
             else None
         )
-        text = "\n".join(map(lambda s: f">{s}", original_text.split("\n")))
+        text = ">" + original_text.replace("\n", "\n>")
         result = generate_proofreading_result(
             context=context,
             logger=logger,
@@ -784,10 +833,13 @@ def display_image_generation_result(
             f"Image generated (url: {image_url} , spent time: {spent_seconds})"
         )
 
-        image_content = requests.get(image_url).content
-        users = [context.actor_user_id]
-        dm_id = client.conversations_open(users=users)["channel"]["id"]
-        text = "\n".join(map(lambda s: f">{s}", prompt.split("\n")))
+        # Open the DM while downloading the image; files_upload_v2 needs the whole image in memory anyway
+        dm_future = slack_api_executor.submit(
+            open_dm, context=context, client=client, user_id=context.actor_user_id
+        )
+        image_content = download_file_content(image_url)
+        dm_id = dm_future.result()
+        text = ">" + prompt.replace("\n", "\n>")
         message_text = (
             "Here's a new image generated using this prompt:\n"
             f"{text}\n"
@@ -803,14 +855,7 @@ def display_image_generation_result(
         )
         file_id = upload["files"][0]["id"]
         uploaded_file_url = upload["files"][0]["url_private"]
-        shared = False
-        time.sleep(1.5)
-        while not shared:
-            latest_file_info = client.files_info(file=file_id)
-            shares = latest_file_info.get("file").get("shares")
-            shared = shares and len(shares.get("private")) > 0
-            if not shared:
-                time.sleep(0.5)
+        wait_until_file_is_shared(client=client, file_id=file_id)
 
         blocks = build_image_generation_result_blocks(
             text=message_text, image_url=uploaded_file_url, model=model
@@ -865,6 +910,22 @@ def ack_image_variations_modal_submission(ack: Ack):
     ack(response_action="update", view=build_image_variations_wip_modal())
 
 
+def _generate_image_variations_for_upload(
+    *, context: BoltContext, image_file: dict, size: str
+) -> dict:
+    image_data: bytes = download_file_content(
+        image_file["url_private"], context.bot_token
+    )
+    image_url = generate_image_variations(
+        context=context,
+        image=image_data,
+        size=size,
+        timeout_seconds=OPENAI_TIMEOUT_SECONDS,
+    )
+    image_content = download_file_content(image_url)
+    return {"file": image_content, "filename": image_file["name"]}
+
+
 def display_image_variations_result(
     client: WebClient,
     context: BoltContext,
@@ -878,41 +939,25 @@ def display_image_variations_result(
         image_files = extract_state_value(payload, "input_files").get("files")
 
         start_time = time.time()
-        threads = []
+        # Open the DM while generating the variations
+        dm_future = slack_api_executor.submit(
+            open_dm, context=context, client=client, user_id=context.actor_user_id
+        )
+        futures = [
+            image_io_executor.submit(
+                _generate_image_variations_for_upload,
+                context=context,
+                image_file=image_file,
+                size=size,
+            )
+            for image_file in image_files
+        ]
         file_uploads: List[dict] = []
-        try:
-            for image_file in image_files:
-
-                def generate_variations():
-                    uploaded_image_url = image_file["url_private"]
-                    image_data: bytes = requests.get(
-                        uploaded_image_url,
-                        headers={"Authorization": f"Bearer {context.bot_token}"},
-                    ).content
-
-                    image_url = generate_image_variations(
-                        context=context,
-                        image=image_data,
-                        size=size,
-                        timeout_seconds=OPENAI_TIMEOUT_SECONDS,
-                    )
-                    image_content = requests.get(image_url).content
-                    file_uploads.append(
-                        {"file": image_content, "filename": image_file["name"]}
-                    )
-
-                thread = threading.Thread(target=generate_variations)
-                thread.daemon = True
-                thread.start()
-                threads.append(thread)
-
-        finally:
-            for t in threads:
-                try:
-                    if t.is_alive():
-                        t.join()
-                except Exception:
-                    pass
+        for future in futures:
+            try:
+                file_uploads.append(future.result())
+            except Exception as e:
+                logger.exception(f"Failed to generate image variations: {e}")
 
         spent_seconds = str(round((time.time() - start_time), 2))
 
@@ -926,8 +971,7 @@ def display_image_variations_result(
             )
             return
 
-        users = [context.actor_user_id]
-        dm_id = client.conversations_open(users=users)["channel"]["id"]
+        dm_id = dm_future.result()
         message_text = (
             "Here are the generated image variations for your inputs:\n"
             f"model: {model}, size: {size}, time spent: {spent_seconds} s"
@@ -939,14 +983,7 @@ def display_image_variations_result(
         )
         uploaded_files = upload["files"]
         file_id = upload["files"][0]["id"]
-        shared = False
-        time.sleep(1.5)
-        while not shared:
-            latest_file_info = client.files_info(file=file_id)
-            shares = latest_file_info.get("file").get("shares")
-            shared = shares and len(shares.get("private")) > 0
-            if not shared:
-                time.sleep(0.5)
+        wait_until_file_is_shared(client=client, file_id=file_id)
 
         blocks = build_image_variations_result_blocks(
             text=message_text,
@@ -1009,7 +1046,7 @@ def ack_chat_from_scratch_modal_submission(
     payload: dict,
 ):
     prompt = extract_state_value(payload, "prompt").get("value")
-    text = "\n".join(map(lambda s: f">{s}", prompt.split("\n")))
+    text = ">" + prompt.replace("\n", "\n>")
     view = build_from_scratch_wip_modal(text)
     ack(response_action="update", view=view)
 
@@ -1024,7 +1061,7 @@ def display_chat_from_scratch_result(
     openai_api_key = context.get("OPENAI_API_KEY")
     try:
         prompt = extract_state_value(payload, "prompt").get("value")
-        text = "\n".join(map(lambda s: f">{s}", prompt.split("\n")))
+        text = ">" + prompt.replace("\n", "\n>")
         result = generate_chatgpt_response(
             context=context,
             logger=logger,
@@ -1106,23 +1143,34 @@ def register_listeners(app: App):
     )
 
 
-MESSAGE_SUBTYPES_TO_SKIP = ["message_changed", "message_deleted"]
+MESSAGE_SUBTYPES_TO_SKIP = frozenset(["message_changed", "message_deleted"])
 
 
 # To reduce unnecessary workload in this app,
 # this before_authorize function skips message changed/deleted events.
 # Especially, "message_changed" events can be triggered many times when the app rapidly updates its reply.
 def before_authorize(
+    context: BoltContext,
     body: dict,
     payload: dict,
     logger: logging.Logger,
     next_,
 ):
+    # Check the subtype first; most requests don't have any
     if (
-        is_event(body)
+        payload.get("subtype") in MESSAGE_SUBTYPES_TO_SKIP
         and payload.get("type") == "message"
-        and payload.get("subtype") in MESSAGE_SUBTYPES_TO_SKIP
+        and is_event(body)
     ):
+        # Edited or deleted messages must not be served from the in-process caches
+        changed_message = payload.get("message") or payload.get("previous_message")
+        if changed_message is None and payload.get("deleted_ts") is not None:
+            # Without the previous message, the deleted one may be a thread's parent
+            changed_message = {"ts": payload["deleted_ts"]}
+        if changed_message is not None:
+            forget_changed_thread_message(
+                context, payload.get("channel"), changed_message
+            )
         logger.debug(
             "Skipped the following middleware and listeners "
             f"for this message event (subtype: {payload.get('subtype')})"
@@ -14,6 +14,13 @@ OPENAI_TIMEOUT_SECONDS = int(
     os.environ.get("OPENAI_TIMEOUT_SECONDS", DEFAULT_OPENAI_TIMEOUT_SECONDS)
 )
 
+# Retries for rate-limited (429) or temporarily failing OpenAI API calls;
+# the OpenAI client waits with exponential backoff, respecting the Retry-After header
+DEFAULT_OPENAI_MAX_RETRIES = 2
+OPENAI_MAX_RETRIES = int(
+    os.environ.get("OPENAI_MAX_RETRIES", DEFAULT_OPENAI_MAX_RETRIES)
+)
+
 DEFAULT_OPENAI_MODEL = "gpt-3.5-turbo"
 OPENAI_MODEL = os.environ.get("OPENAI_MODEL", DEFAULT_OPENAI_MODEL)
 
@@ -49,10 +56,59 @@ OPENAI_FUNCTION_CALL_MODULE_NAME = os.environ.get(
     "OPENAI_FUNCTION_CALL_MODULE_NAME", DEFAULT_OPENAI_FUNCTION_CALL_MODULE_NAME
 )
 
+# While receiving OpenAI's streaming response, this app updates its reply message
+# when either of the following thresholds is reached since the last update
+DEFAULT_STREAM_FLUSH_MS = 1000
+STREAM_FLUSH_MS = int(os.environ.get("STREAM_FLUSH_MS", DEFAULT_STREAM_FLUSH_MS))
+
+DEFAULT_STREAM_FLUSH_CHARS = 400
+STREAM_FLUSH_CHARS = int(
+    os.environ.get("STREAM_FLUSH_CHARS", DEFAULT_STREAM_FLUSH_CHARS)
+)
+
+# When a user posts several messages in a row, this app waits for this period before replying
+# so that only the last message is replied to (disabled by default)
+# The messages must reach the same process, so this is not effective on AWS Lambda
+DEFAULT_REPLY_DEBOUNCE_MS = 0
+REPLY_DEBOUNCE_MS = int(os.environ.get("REPLY_DEBOUNCE_MS", DEFAULT_REPLY_DEBOUNCE_MS))
+
+# When the string is "true", stream replies in threads with chat.startStream/appendStream/stopStream
+# instead of updating the message with chat.update
+SLACK_CHAT_STREAM_ENABLED = (
+    os.environ.get("SLACK_CHAT_STREAM_ENABLED", "false") == "true"
+)
+
+# Retries for the final chat.update call of a reply when it is rate-limited;
+# Slack's Retry-After header decides how long to wait
+DEFAULT_SLACK_RATE_LIMIT_RETRIES = 3
+SLACK_RATE_LIMIT_RETRIES = int(
+    os.environ.get("SLACK_RATE_LIMIT_RETRIES", DEFAULT_SLACK_RATE_LIMIT_RETRIES)
+)
+
 USE_SLACK_LANGUAGE = os.environ.get("USE_SLACK_LANGUAGE", "true") == "true"
 
 SLACK_APP_LOG_LEVEL = os.environ.get("SLACK_APP_LOG_LEVEL", "DEBUG")
 
+# The number of threads that run lazy listeners (e.g., OpenAI streaming replies) concurrently
+DEFAULT_SLACK_APP_LISTENER_MAX_WORKERS = 32
+SLACK_APP_LISTENER_MAX_WORKERS = int(
+    os.environ.get(
+        "SLACK_APP_LISTENER_MAX_WORKERS", DEFAULT_SLACK_APP_LISTENER_MAX_WORKERS
+    )
+)
+
+# The number of threads for the Slack API calls that run alongside each conversation
+# (e.g., posting the loading message while translating it); two per listener by default
+SLACK_API_MAX_WORKERS = int(
+    os.environ.get("SLACK_API_MAX_WORKERS", SLACK_APP_LISTENER_MAX_WORKERS * 2)
+)
+
+# The number of threads for downloading and generating images; this bounds
+# the number of parallel OpenAI image requests
+IMAGE_IO_MAX_WORKERS = int(
+    os.environ.get("IMAGE_IO_MAX_WORKERS", max(SLACK_APP_LISTENER_MAX_WORKERS // 4, 1))
+)
+
 TRANSLATE_MARKDOWN = os.environ.get("TRANSLATE_MARKDOWN", "false") == "true"
 
 REDACTION_ENABLED = os.environ.get("REDACTION_ENABLED", "false") == "true"
@@ -1,10 +1,10 @@
-from typing import Optional
+import threading
+from typing import Optional, Dict
 
-from openai import OpenAI
-from openai.lib.azure import AzureOpenAI
 from slack_bolt import BoltContext
 
 from .openai_constants import GPT_4O_MINI_MODEL
+from .openai_ops import build_openai_client
 
 # All the supported languages for Slack app as of March 2023
 _locale_to_lang = {
@@ -31,6 +31,10 @@ def from_locale_to_lang(locale: Optional[str]) -> Optional[str]:
 
 
 _translation_result_cache = {}
+# Concurrent requests for the same translation wait for the first one
+# instead of calling OpenAI API in parallel
+_translation_locks: Dict[str, threading.Lock] = {}
+_translation_locks_lock = threading.Lock()
 
 
 def translate(*, openai_api_key: Optional[str], context: BoltContext, text: str) -> str:
@@ -41,21 +45,40 @@ def translate(*, openai_api_key: Optional[str], context: BoltContext, text: str)
     if lang is None or lang == "English":
         return text
 
-    cached_result = _translation_result_cache.get(f"{lang}:{text}")
+    cache_key = f"{lang}:{text}"
+    cached_result = _translation_result_cache.get(cache_key)
     if cached_result is not None:
         return cached_result
-    if context.get("OPENAI_API_TYPE") == "azure":
-        client = AzureOpenAI(
-            api_key=openai_api_key,
-            api_version=context.get("OPENAI_API_VERSION"),
-            azure_endpoint=context.get("OPENAI_API_BASE"),
-            azure_deployment=context.get("OPENAI_DEPLOYMENT_ID"),
-        )
-    else:
-        client = OpenAI(
-            api_key=openai_api_key,
-            base_url=context.get("OPENAI_API_BASE"),
+    with _translation_locks_lock:
+        lock = _translation_locks.setdefault(cache_key, threading.Lock())
+    with lock:
+        cached_result = _translation_result_cache.get(cache_key)
+        if cached_result is not None:
+            return cached_result
+        translated_text = _translate_with_openai(
+            openai_api_key=openai_api_key,
+            context=context,
+            lang=lang,
+            text=text,
         )
+        _translation_result_cache[cache_key] = translated_text
+        return translated_text
+
+
+def _translate_with_openai(
+    *,
+    openai_api_key: str,
+    context: BoltContext,
+    lang: str,
+    text: str,
+) -> str:
+    client = build_openai_client(
+        openai_api_key=openai_api_key,
+        openai_api_type=context.get("OPENAI_API_TYPE"),
+        openai_api_base=context.get("OPENAI_API_BASE"),
+        openai_api_version=context.get("OPENAI_API_VERSION"),
+        openai_deployment_id=context.get("OPENAI_DEPLOYMENT_ID"),
+    )
     response = client.chat.completions.create(
         model=GPT_4O_MINI_MODEL,
         messages=[
@@ -86,6 +109,4 @@ def translate(*, openai_api_key: Optional[str], context: BoltContext, text: str)
         logit_bias={},
         user="system",
     )
-    translated_text = response.model_dump()["choices"][0]["message"].get("content")
-    _translation_result_cache[f"{lang}:{text}"] = translated_text
-    return translated_text
+    return response.model_dump()["choices"][0]["message"].get("content")
@@ -1,11 +1,40 @@
 import re
 
+# Splits a string into parts based on code blocks and inline code
+_code_pattern = re.compile(r"(?s)(```.+?```|`[^`\n]+?`)")
+
+_slack_to_markdown_replacements = [
+    (re.compile(o), n)
+    for o, n in [
+        (r"\*(?!\s)([^\*\n]+?)(?<!\s)\*", r"**\1**"),  # *bold* to **bold**
+        (r"_(?!\s)([^_\n]+?)(?<!\s)_", r"*\1*"),  # _italic_ to *italic*
+        (r"~(?!\s)([^~\n]+?)(?<!\s)~", r"~~\1~~"),  # ~strike~ to ~~strike~~
+    ]
+]
+
+_markdown_to_slack_replacements = [
+    (re.compile(o), n)
+    for o, n in [
+        (
+            r"\*\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*\*",
+            r"_*\1*_",
+        ),  # ***bold italic*** to *_bold italic_*
+        (
+            r"(?<![\*_])\*(?!\s)([^\*\n]+?)(?<!\s)\*(?![\*_])",
+            r"_\1_",
+        ),  # *italic* to _italic_
+        (r"\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*", r"*\1*"),  # **bold** to *bold*
+        (r"__(?!\s)([^_\n]+?)(?<!\s)__", r"*\1*"),  # __bold__ to *bold*
+        (r"~~(?!\s)([^~\n]+?)(?<!\s)~~", r"~\1~"),  # ~~strike~~ to ~strike~
+    ]
+]
+
 
 # Conversion from Slack mrkdwn to OpenAI markdown
 # See also: https://api.slack.com/reference/surfaces/formatting#basics
 def slack_to_markdown(content: str) -> str:
     # Split the input string into parts based on code blocks and inline code
-    parts = re.split(r"(?s)(```.+?```|`[^`\n]+?`)", content)
+    parts = _code_pattern.split(content)
 
     # Apply the bold, italic, and strikethrough formatting to text not within code
     result = ""
@@ -13,12 +42,8 @@ def slack_to_markdown(content: str) -> str:
         if part.startswith("```") or part.startswith("`"):
             result += part
         else:
-            for o, n in [
-                (r"\*(?!\s)([^\*\n]+?)(?<!\s)\*", r"**\1**"),  # *bold* to **bold**
-                (r"_(?!\s)([^_\n]+?)(?<!\s)_", r"*\1*"),  # _italic_ to *italic*
-                (r"~(?!\s)([^~\n]+?)(?<!\s)~", r"~~\1~~"),  # ~strike~ to ~~strike~~
-            ]:
-                part = re.sub(o, n, part)
+            for o, n in _slack_to_markdown_replacements:
+                part = o.sub(n, part)
             result += part
     return result
 
@@ -27,7 +52,7 @@ def slack_to_markdown(content: str) -> str:
 # See also: https://api.slack.com/reference/surfaces/formatting#basics
 def markdown_to_slack(content: str) -> str:
     # Split the input string into parts based on code blocks and inline code
-    parts = re.split(r"(?s)(```.+?```|`[^`\n]+?`)", content)
+    parts = _code_pattern.split(content)
 
     # Apply the bold, italic, and strikethrough formatting to text not within code
     result = ""
@@ -35,19 +60,7 @@ def markdown_to_slack(content: str) -> str:
         if part.startswith("```") or part.startswith("`"):
             result += part
         else:
-            for o, n in [
-                (
-                    r"\*\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*\*",
-                    r"_*\1*_",
-                ),  # ***bold italic*** to *_bold italic_*
-                (
-                    r"(?<![\*_])\*(?!\s)([^\*\n]+?)(?<!\s)\*(?![\*_])",
-                    r"_\1_",
-                ),  # *italic* to _italic_
-                (r"\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*", r"*\1*"),  # **bold** to *bold*
-                (r"__(?!\s)([^_\n]+?)(?<!\s)__", r"*\1*"),  # __bold__ to *bold*
-                (r"~~(?!\s)([^~\n]+?)(?<!\s)~~", r"~\1~"),  # ~~strike~~ to ~strike~
-            ]:
-                part = re.sub(o, n, part)
+            for o, n in _markdown_to_slack_replacements:
+                part = o.sub(n, part)
             result += part
     return result
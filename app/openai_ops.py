@@ -3,17 +3,25 @@ import threading
 import time
 import re
 import json
+from functools import lru_cache
 from typing import List, Dict, Tuple, Optional, Union
 from importlib import import_module
 
-from openai import OpenAI, Stream
+from openai import OpenAI, Stream, DefaultHttpxClient
 from openai.lib.azure import AzureOpenAI
 from openai.types import Completion
 import tiktoken
 
 from slack_bolt import BoltContext
 from slack_sdk.web import WebClient, SlackResponse
+from slack_sdk.errors import SlackApiError
 
+from app.env import (
+    OPENAI_MAX_RETRIES,
+    STREAM_FLUSH_MS,
+    STREAM_FLUSH_CHARS,
+    SLACK_CHAT_STREAM_ENABLED,
+)
 from app.markdown_conversion import slack_to_markdown, markdown_to_slack
 from app.openai_constants import (
     MAX_TOKENS,
@@ -42,7 +50,11 @@ from app.openai_constants import (
     MODEL_TOKENS,
     MODEL_FALLBACKS,
 )
-from app.slack_ops import update_wip_message
+from app.slack_ops import (
+    update_wip_message,
+    start_streaming_reply,
+    stop_streaming_reply,
+)
 
 # ----------------------------
 # Internal functions
@@ -50,8 +62,13 @@ from app.slack_ops import update_wip_message
 
 _prompt_tokens_used_by_function_call_cache: Optional[int] = None
 
+# Shared by all the OpenAI API clients in this app to reuse keep-alive connections
+_openai_http_client = DefaultHttpxClient()
+
 
 # Format message from Slack to send to OpenAI
+# Every turn in a thread formats all the past replies again, so the results are cached
+@lru_cache(maxsize=4096)
 def format_openai_message_content(
     content: str, translate_markdown: bool
 ) -> Optional[str]:
@@ -80,12 +97,16 @@ def messages_within_context_window(
     if context.get("OPENAI_FUNCTION_CALL_MODULE_NAME") is not None:
         max_context_tokens -= calculate_tokens_necessary_for_function_call(context)
     num_context_tokens = 0  # Number of tokens in the context window just before the earliest message is deleted
-    while (num_tokens := calculate_num_tokens(messages)) > max_context_tokens:
+    # Count the whole list only once; the tokens of a removed message are subtracted afterwards
+    num_tokens = calculate_num_tokens(messages)
+    while num_tokens > max_context_tokens:
         removed = False
         for i, message in enumerate(messages):
             if message["role"] in ("user", "assistant", "function"):
                 num_context_tokens = num_tokens
                 del messages[i]
+                # calculate_num_tokens adds 3 tokens for the reply priming, which still remain
+                num_tokens -= calculate_num_tokens([message]) - 3
                 removed = True
                 break
         if not removed:
@@ -111,19 +132,14 @@ def make_synchronous_openai_call(
     openai_organization_id: Optional[str],
     timeout_seconds: int,
 ) -> Completion:
-    if openai_api_type == "azure":
-        client = AzureOpenAI(
-            api_key=openai_api_key,
-            api_version=openai_api_version,
-            azure_endpoint=openai_api_base,
-            azure_deployment=openai_deployment_id,
-        )
-    else:
-        client = OpenAI(
-            api_key=openai_api_key,
-            base_url=openai_api_base,
-            organization=openai_organization_id,
-        )
+    client = build_openai_client(
+        openai_api_key=openai_api_key,
+        openai_api_type=openai_api_type,
+        openai_api_base=openai_api_base,
+        openai_api_version=openai_api_version,
+        openai_deployment_id=openai_deployment_id,
+        openai_organization_id=openai_organization_id,
+    )
     return client.chat.completions.create(
         model=model,
         messages=messages,
@@ -157,19 +173,14 @@ def start_receiving_openai_response(
     kwargs = {}
     if function_call_module_name is not None:
         kwargs["functions"] = import_module(function_call_module_name).functions
-    if openai_api_type == "azure":
-        client = AzureOpenAI(
-            api_key=openai_api_key,
-            api_version=openai_api_version,
-            azure_endpoint=openai_api_base,
-            azure_deployment=openai_deployment_id,
-        )
-    else:
-        client = OpenAI(
-            api_key=openai_api_key,
-            base_url=openai_api_base,
-            organization=openai_organization_id,
-        )
+    client = build_openai_client(
+        openai_api_key=openai_api_key,
+        openai_api_type=openai_api_type,
+        openai_api_base=openai_api_base,
+        openai_api_version=openai_api_version,
+        openai_deployment_id=openai_deployment_id,
+        openai_organization_id=openai_organization_id,
+    )
     return client.chat.completions.create(
         model=model,
         messages=messages,
@@ -203,9 +214,26 @@ def consume_openai_stream_to_write_reply(
         "content": "",
     }
     messages.append(assistant_reply)
-    word_count = 0
+    # Coalesce the streamed deltas to avoid calling chat.update for every few tokens;
+    # the time limit counts from the oldest delta that hasn't been written yet
+    unflushed_since = start_time
+    num_unflushed_chars = 0
     threads = []
     function_call: Dict[str, str] = {"name": "", "arguments": ""}
+    # Joining the deltas only when writing the reply avoids copying the whole text for every delta
+    reply_chunks: List[str] = []
+    # Slack's streaming APIs work only for replies in a thread
+    thread_ts = wip_reply["message"].get("thread_ts")
+    use_chat_stream = (
+        SLACK_CHAT_STREAM_ENABLED
+        and thread_ts is not None
+        and hasattr(client, "chat_startStream")
+    )
+    streaming_reply_ts: Optional[str] = None
+    # The markdown text already appended to the native stream
+    streamed_markdown = ""
+    # Whether formatting the whole reply has changed the text already streamed
+    stream_diverged = False
     try:
         loading_character = " ... :writing_hand:"
         for chunk in stream:
@@ -220,32 +248,86 @@ def consume_openai_stream_to_write_reply(
                 break
             delta = item.get("delta")
             if delta.get("content") is not None:
-                word_count += 1
-                assistant_reply["content"] += delta.get("content")
-                if word_count >= 20:
+                reply_chunks.append(delta.get("content"))
+                if num_unflushed_chars == 0:
+                    unflushed_since = time.time()
+                num_unflushed_chars += len(delta.get("content"))
+                if use_chat_stream and (
+                    num_unflushed_chars >= STREAM_FLUSH_CHARS
+                    or (time.time() - unflushed_since) * 1000 >= STREAM_FLUSH_MS
+                ):
+                    assistant_reply["content"] = "".join(reply_chunks)
+                    markdown_text = _unstreamed_markdown(
+                        streamed_markdown,
+                        _streamable_markdown(assistant_reply["content"]),
+                    )
+                    if markdown_text is None:
+                        # Appending again would repeat the reply; the final update fixes it
+                        stream_diverged = True
+                    if stream_diverged:
+                        markdown_text = ""
+                    # The appended chunks must keep their order, so this runs in this thread
+                    if streaming_reply_ts is None and markdown_text:
+                        streaming_reply_ts = start_streaming_reply(
+                            client=client,
+                            context=context,
+                            thread_ts=thread_ts,
+                            markdown_text=markdown_text,
+                            user=user_id,
+                        )["ts"]
+                        # The streaming message replaces the loading message
+                        client.chat_delete(
+                            channel=context.channel_id,
+                            ts=wip_reply["message"]["ts"],
+                        )
+                        wip_reply["message"]["ts"] = streaming_reply_ts
+                    elif markdown_text:
+                        client.chat_appendStream(
+                            channel=context.channel_id,
+                            ts=streaming_reply_ts,
+                            markdown_text=markdown_text,
+                        )
+                    streamed_markdown += markdown_text
+                    wip_reply["message"]["text"] = format_assistant_reply(
+                        assistant_reply["content"], translate_markdown
+                    )
+                    num_unflushed_chars = 0
+                elif (
+                    num_unflushed_chars >= STREAM_FLUSH_CHARS
+                    or (time.time() - unflushed_since) * 1000 >= STREAM_FLUSH_MS
+                ) and not any(t.is_alive() for t in threads):
+                    # Skipping a flush while the previous update is still in flight
+                    # keeps the updates in order; the next flush carries the whole text
+                    assistant_reply["content"] = "".join(reply_chunks)
 
                     def update_message():
                         assistant_reply_text = format_assistant_reply(
                             assistant_reply["content"], translate_markdown
                         )
                         wip_reply["message"]["text"] = assistant_reply_text
-                        update_wip_message(
-                            client=client,
-                            channel=context.channel_id,
-                            ts=wip_reply["message"]["ts"],
-                            text=assistant_reply_text + loading_character,
-                            messages=messages,
-                            user=user_id,
-                        )
+                        try:
+                            update_wip_message(
+                                client=client,
+                                channel=context.channel_id,
+                                ts=wip_reply["message"]["ts"],
+                                text=assistant_reply_text + loading_character,
+                                messages=messages,
+                                user=user_id,
+                                retries=0,
+                            )
+                        except SlackApiError as e:
+                            # Only the final update is retried when rate-limited
+                            if e.response.status_code != 429:
+                                raise
 
                     thread = threading.Thread(target=update_message)
                     thread.daemon = True
                     thread.start()
                     threads.append(thread)
-                    word_count = 0
+                    num_unflushed_chars = 0
             elif delta.get("function_call") is not None:
                 # Ignore function call suggestions after content has been received
-                if assistant_reply["content"] == "":
+                if not any(reply_chunks):
                     for k in function_call.keys():
                         function_call[k] += delta["function_call"].get(k) or ""
                     assistant_reply["function_call"] = function_call
@@ -256,6 +338,7 @@ def consume_openai_stream_to_write_reply(
                     t.join()
             except Exception:
                 pass
+        assistant_reply["content"] = "".join(reply_chunks)
 
         if function_call["name"] != "":
             function_call_module_name = context.get("OPENAI_FUNCTION_CALL_MODULE_NAME")
@@ -299,15 +382,48 @@ def consume_openai_stream_to_write_reply(
             assistant_reply["content"], translate_markdown
         )
         wip_reply["message"]["text"] = assistant_reply_text
-        update_wip_message(
-            client=client,
-            channel=context.channel_id,
-            ts=wip_reply["message"]["ts"],
-            text=assistant_reply_text,
-            messages=messages,
-            user=user_id,
-        )
+        if streaming_reply_ts is not None:
+            markdown_text = _unstreamed_markdown(
+                streamed_markdown,
+                format_assistant_reply(assistant_reply["content"], False),
+            )
+            stop_streaming_reply(
+                client=client,
+                channel=context.channel_id,
+                ts=streaming_reply_ts,
+                markdown_text=None if stream_diverged else markdown_text or None,
+                messages=messages,
+                user=user_id,
+            )
+            streaming_reply_ts = None
+            if stream_diverged or markdown_text is None:
+                # Replace the streamed text that differs from the formatted reply
+                update_wip_message(
+                    client=client,
+                    channel=context.channel_id,
+                    ts=wip_reply["message"]["ts"],
+                    text=assistant_reply_text,
+                    messages=messages,
+                    user=user_id,
+                )
+        else:
+            update_wip_message(
+                client=client,
+                channel=context.channel_id,
+                ts=wip_reply["message"]["ts"],
+                text=assistant_reply_text,
+                messages=messages,
+                user=user_id,
+            )
     finally:
+        if streaming_reply_ts is not None:
+            # Stop the stream so that the error handlers can update the message
+            try:
+                client.chat_stopStream(
+                    channel=context.channel_id, ts=streaming_reply_ts
+                )
+            except Exception:
+                pass
         for t in threads:
             try:
                 if t.is_alive():
@@ -372,12 +488,18 @@ def context_length(
         raise NotImplementedError(error)
 
 
+# Every turn in a thread counts the tokens in all the past messages again, so the results are cached
+@lru_cache(maxsize=4096)
+def _count_tokens_in_text(text: str, encoding_name: str) -> int:
+    return len(tiktoken.get_encoding(encoding_name).encode(text))
+
+
 def encode_and_count_tokens(
     value: Union[str, List[Dict[str, Union[str, Dict[str, str]]]], Dict[str, str]],
     encoding: tiktoken.Encoding,
 ) -> int:
     if isinstance(value, str):
-        return len(encoding.encode(value))
+        return _count_tokens_in_text(value, encoding.name)
     elif isinstance(value, list):
         return sum(encode_and_count_tokens(item, encoding) for item in value)
     elif isinstance(value, dict):
@@ -484,10 +606,46 @@ def format_assistant_reply(content: str, translate_markdown: bool) -> str:
     return content
 
 
+# The leading "<@U...>: " that format_assistant_reply removes, while it's still incomplete
+_PARTIAL_LEADING_MENTION = re.compile(r"\n*(<(@(U[^>\s]*(>(\s?(:\s?)?)?)?)?)?)?")
+# The language tag after a code fence, while more characters can still be added to it
+_PARTIAL_CODE_FENCE_TAG = re.compile(r"\s*\S*")
+
+
+def _streamable_markdown(content: str) -> str:
+    # format_assistant_reply rewrites these parts only once they are complete,
+    # so they are held back until a later flush
+    if _PARTIAL_LEADING_MENTION.fullmatch(content):
+        return ""
+    last_fence = content.rfind("```")
+    if last_fence >= 0 and _PARTIAL_CODE_FENCE_TAG.fullmatch(content, last_fence + 3):
+        content = content[:last_fence]
+    return format_assistant_reply(content, False)
+
+
+def _unstreamed_markdown(streamed_markdown: str, markdown_text: str) -> Optional[str]:
+    # The text appended to a native stream can't be changed anymore,
+    # so this returns None when the formatted text no longer starts with it
+    if not markdown_text.startswith(streamed_markdown):
+        return None
+    num_streamed_chars = len(streamed_markdown)
+    return markdown_text[num_streamed_chars:]
+
+
 def build_system_text(
     system_text_template: str, translate_markdown: bool, context: BoltContext
 ):
-    system_text = system_text_template.format(bot_user_id=context.bot_user_id)
+    return _build_system_text(
+        system_text_template, translate_markdown, context.bot_user_id
+    )
+
+
+# The result never changes for the same bot user, so this app doesn't have to build it for every event
+@lru_cache(maxsize=64)
+def _build_system_text(
+    system_text_template: str, translate_markdown: bool, bot_user_id: Optional[str]
+) -> str:
+    system_text = system_text_template.format(bot_user_id=bot_user_id)
     # Translate format hint in system prompt
     if translate_markdown is True:
         system_text = slack_to_markdown(system_text)
@@ -660,15 +818,39 @@ def generate_chatgpt_response(
 
 
 def create_openai_client(context: BoltContext) -> Union[OpenAI, AzureOpenAI]:
-    if context.get("OPENAI_API_TYPE") == "azure":
+    return build_openai_client(
+        openai_api_key=context.get("OPENAI_API_KEY"),
+        openai_api_type=context.get("OPENAI_API_TYPE"),
+        openai_api_base=context.get("OPENAI_API_BASE"),
+        openai_api_version=context.get("OPENAI_API_VERSION"),
+        openai_deployment_id=context.get("OPENAI_DEPLOYMENT_ID"),
+    )
+
+
+def build_openai_client(
+    *,
+    openai_api_key: str,
+    openai_api_type: Optional[str],
+    openai_api_base: Optional[str],
+    openai_api_version: Optional[str],
+    openai_deployment_id: Optional[str],
+    openai_organization_id: Optional[str] = None,
+) -> Union[OpenAI, AzureOpenAI]:
+    # Creating a client is cheap as long as the underlying HTTP client is reused
+    if openai_api_type == "azure":
         return AzureOpenAI(
-            api_key=context.get("OPENAI_API_KEY"),
-            api_version=context.get("OPENAI_API_VERSION"),
-            azure_endpoint=context.get("OPENAI_API_BASE"),
-            azure_deployment=context.get("OPENAI_DEPLOYMENT_ID"),
+            api_key=openai_api_key,
+            api_version=openai_api_version,
+            azure_endpoint=openai_api_base,
+            azure_deployment=openai_deployment_id,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=_openai_http_client,
         )
     else:
         return OpenAI(
-            api_key=context.get("OPENAI_API_KEY"),
-            base_url=context.get("OPENAI_API_BASE"),
+            api_key=openai_api_key,
+            base_url=openai_api_base,
+            organization=openai_organization_id,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=_openai_http_client,
         )
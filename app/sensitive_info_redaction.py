@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 from app.env import (
     REDACT_EMAIL_PATTERN,
@@ -9,7 +10,17 @@ from app.env import (
     REDACTION_ENABLED,
 )
 
+_redaction_replacements = [
+    (re.compile(REDACT_EMAIL_PATTERN), "[EMAIL]"),
+    (re.compile(REDACT_CREDIT_CARD_PATTERN), "[CREDIT CARD]"),
+    (re.compile(REDACT_PHONE_PATTERN), "[PHONE]"),
+    (re.compile(REDACT_SSN_PATTERN), "[SSN]"),
+    (re.compile(REDACT_USER_DEFINED_PATTERN), "[REDACTED]"),
+]
 
+
+# The same thread replies are redacted again for every new message in the thread
+@lru_cache(maxsize=4096)
 def redact_string(input_string: str) -> str:
     """
     Redact sensitive information from a string (inspired by @quangnhut123)
@@ -22,12 +33,7 @@ def redact_string(input_string: str) -> str:
     """
     output_string = input_string
     if REDACTION_ENABLED:
-        output_string = re.sub(REDACT_EMAIL_PATTERN, "[EMAIL]", output_string)
-        output_string = re.sub(
-            REDACT_CREDIT_CARD_PATTERN, "[CREDIT CARD]", output_string
-        )
-        output_string = re.sub(REDACT_PHONE_PATTERN, "[PHONE]", output_string)
-        output_string = re.sub(REDACT_SSN_PATTERN, "[SSN]", output_string)
-        output_string = re.sub(REDACT_USER_DEFINED_PATTERN, "[REDACTED]", output_string)
+        for pattern, replacement in _redaction_replacements:
+            output_string = pattern.sub(replacement, output_string)
 
     return output_string
@@ -1,35 +1,104 @@
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
 from typing import Optional
-from typing import List, Dict
+from typing import List, Dict, Tuple, Callable, Generic, TypeVar
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from slack_sdk.web import WebClient, SlackResponse
+from slack_sdk.web import base_client
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
 from slack_bolt import BoltContext
 
-from app.env import IMAGE_FILE_ACCESS_ENABLED
+from app.env import (
+    IMAGE_FILE_ACCESS_ENABLED,
+    OPENAI_TIMEOUT_SECONDS,
+    SLACK_RATE_LIMIT_RETRIES,
+)
 from app.markdown_conversion import slack_to_markdown
 
 
 # ----------------------------
-# General operations in a channel
+# Slack API client
 # ----------------------------
 
 
-def find_parent_message(
-    client: WebClient, channel_id: Optional[str], thread_ts: Optional[str]
-) -> Optional[dict]:
-    if channel_id is None or thread_ts is None:
-        return None
+class _Orjson:
+    loads = staticmethod(orjson.loads)
 
-    messages = client.conversations_history(
-        channel=channel_id,
-        latest=thread_ts,
-        limit=1,
-        inclusive=True,
-    ).get("messages", [])
+    @staticmethod
+    def dumps(obj, **kwargs) -> str:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            # e.g., dict keys that are not strings
+            return json.dumps(obj, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(json, name)
+
+
+def use_orjson_for_slack_api_calls() -> None:
+    # conversations.replies responses with metadata can be hundreds of KB,
+    # and the request bodies of chat.postMessage/update carry the conversation metadata,
+    # so encoding/decoding them with orjson saves a few milliseconds for each event
+    base_client.json = _Orjson()
+
+
+# ----------------------------
+# In-process caches
+# ----------------------------
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+# A thread-safe dict that drops the least recently updated items over max_size
+class _BoundedLRUCache(Generic[K, V]):
+    def __init__(self, max_size: int):
+        self._items: "OrderedDict[K, V]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_size = max_size
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            return self._items.get(key)
 
-    return messages[0] if len(messages) > 0 else None
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._set(key, value)
+
+    def update(self, key: K, func: Callable[[Optional[V]], Optional[V]]) -> None:
+        # Replaces the value with func(current value) atomically; None removes the item
+        with self._lock:
+            current = self._items.get(key)
+            value = func(current)
+            if value is None:
+                self._items.pop(key, None)
+            elif value is not current:
+                self._set(key, value)
+
+    def pop(self, key: K) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def _set(self, key: K, value: V) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self._max_size:
+            self._items.popitem(last=False)
+
+
+# ----------------------------
+# General operations in a channel
+# ----------------------------
 
 
 def is_this_app_mentioned(context: BoltContext, parent_message: dict) -> bool:
@@ -37,6 +106,158 @@ def is_this_app_mentioned(context: BoltContext, parent_message: dict) -> bool:
     return f"<@{context.bot_user_id}>" in parent_message_text
 
 
+# The DM channel ID between this app and each user never changes
+_dm_channel_ids: "_BoundedLRUCache[Tuple[Optional[str], Optional[str], str], str]" = (
+    _BoundedLRUCache(max_size=10000)
+)
+
+
+def open_dm(*, context: BoltContext, client: WebClient, user_id: str) -> str:
+    key = (context.enterprise_id, context.team_id, user_id)
+    dm_id = _dm_channel_ids.get(key)
+    if dm_id is not None:
+        return dm_id
+
+    dm_id = client.conversations_open(users=[user_id])["channel"]["id"]
+    _dm_channel_ids.set(key, dm_id)
+    return dm_id
+
+
+# Both caches below are updated on edited or deleted messages only when this process
+# receives the message_changed or message_deleted event, so a deployment running several
+# processes can keep using the old messages. Such deployments should disable them.
+_thread_caches_enabled = True
+
+
+def disable_thread_caches() -> None:
+    global _thread_caches_enabled
+    _thread_caches_enabled = False
+
+
+# Whether the parent message mentions this app for each (enterprise_id, team_id, channel, thread_ts);
+# a Slack Connect channel can be shared with other workspaces that installed this app
+_this_app_threads: (
+    "_BoundedLRUCache[Tuple[Optional[str], Optional[str], str, str], bool]"
+) = _BoundedLRUCache(max_size=10000)
+
+
+def remember_this_app_thread(
+    context: BoltContext, channel: str, thread_ts: str, is_for_this_app: bool
+):
+    if _thread_caches_enabled:
+        key = (context.enterprise_id, context.team_id, channel, thread_ts)
+        _this_app_threads.set(key, is_for_this_app)
+
+
+def is_this_app_thread(
+    *,
+    context: BoltContext,
+    client: WebClient,
+    channel: str,
+    thread_ts: str,
+) -> bool:
+    is_for_this_app = _this_app_threads.get(
+        (context.enterprise_id, context.team_id, channel, thread_ts)
+    )
+    if is_for_this_app is not None:
+        return is_for_this_app
+
+    # The first message in the replies is the parent message
+    replies = client.conversations_replies(
+        channel=channel,
+        ts=thread_ts,
+        limit=1,
+    ).get("messages", [])
+    if len(replies) == 0 or replies[0].get("ts") != thread_ts:
+        return False
+    is_for_this_app = is_this_app_mentioned(context, replies[0])
+    remember_this_app_thread(context, channel, thread_ts, is_for_this_app)
+    return is_for_this_app
+
+
+# The replies in a thread that are unlikely to change anymore for each (channel, thread_ts)
+_settled_thread_replies: (
+    "_BoundedLRUCache[Tuple[str, str], Tuple[float, List[dict]]]"
+) = _BoundedLRUCache(max_size=2048)
+_settled_thread_replies_ttl_seconds = 3600
+# This app's replies can be updated while streaming (and retrying rate-limited updates)
+_settled_thread_replies_min_age_seconds = OPENAI_TIMEOUT_SECONDS + 60
+
+
+def fetch_thread_replies(
+    *,
+    client: WebClient,
+    channel: str,
+    thread_ts: str,
+) -> List[dict]:
+    # The returned replies are also kept in the cache, so callers must not modify them
+    key = (channel, thread_ts)
+    now = time.time()
+    cached = _settled_thread_replies.get(key)
+    if cached is not None and now - cached[0] < _settled_thread_replies_ttl_seconds:
+        settled_replies = cached[1]
+    else:
+        settled_replies = []
+
+    if len(settled_replies) > 0:
+        # Fetch only the replies posted after the ones this process already has
+        last_settled_ts = settled_replies[-1]["ts"]
+        new_replies = [
+            reply
+            for reply in client.conversations_replies(
+                channel=channel,
+                ts=thread_ts,
+                oldest=last_settled_ts,
+                include_all_metadata=True,
+                limit=1000,
+            ).get("messages", [])
+            if float(reply["ts"]) > float(last_settled_ts)
+        ]
+        replies = settled_replies + new_replies
+    else:
+        replies = client.conversations_replies(
+            channel=channel,
+            ts=thread_ts,
+            include_all_metadata=True,
+            limit=1000,
+        ).get("messages", [])
+
+    settled_replies = [
+        reply
+        for reply in replies
+        if now - float(reply["ts"]) >= _settled_thread_replies_min_age_seconds
+    ]
+    if _thread_caches_enabled and len(settled_replies) > 0:
+        # Skip the write if a message in this thread has changed during the fetch
+        _settled_thread_replies.update(
+            key,
+            lambda current: ((now, settled_replies) if current is cached else current),
+        )
+    return replies
+
+
+def forget_changed_thread_message(
+    context: BoltContext, channel: str, message: dict
+) -> None:
+    thread_ts = message.get("thread_ts") or message.get("ts")
+    if channel is None or thread_ts is None:
+        return
+    # This app's replies that are still being written are too new to be cached
+    if (
+        _thread_caches_enabled
+        and time.time() - float(message["ts"])
+        >= _settled_thread_replies_min_age_seconds
+    ):
+        # A new empty entry instead of removing the cached one makes sure that
+        # the fetches started before this change don't write their replies back
+        _settled_thread_replies.set((channel, thread_ts), (0.0, []))
+    if message.get("ts") == thread_ts:
+        # The mention in the parent message may have been added or removed
+        _this_app_threads.pop(
+            (context.enterprise_id, context.team_id, channel, thread_ts)
+        )
+
+
 def build_thread_replies_as_combined_text(
     *,
     context: BoltContext,
@@ -68,6 +289,31 @@ def build_thread_replies_as_combined_text(
 # WIP reply message stuff
 # ----------------------------
 
+# The latest message ts that this process has received for each (channel, thread_ts)
+_latest_message_ts_in_threads: "_BoundedLRUCache[Tuple[str, Optional[str]], str]" = (
+    _BoundedLRUCache(max_size=10000)
+)
+
+
+def remember_latest_message_ts(
+    channel: str, thread_ts: Optional[str], message_ts: str
+) -> None:
+    _latest_message_ts_in_threads.update(
+        (channel, thread_ts),
+        lambda current_ts: (
+            message_ts
+            if current_ts is None or float(current_ts) < float(message_ts)
+            else current_ts
+        ),
+    )
+
+
+def is_newer_message_received(
+    channel: str, thread_ts: Optional[str], message_ts: str
+) -> bool:
+    latest_ts = _latest_message_ts_in_threads.get((channel, thread_ts))
+    return latest_ts is not None and float(latest_ts) > float(message_ts)
+
 
 def post_wip_message(
     *,
@@ -90,6 +336,44 @@ def post_wip_message(
     )
 
 
+def start_streaming_reply(
+    *,
+    client: WebClient,
+    context: BoltContext,
+    thread_ts: str,
+    markdown_text: str,
+    user: str,
+) -> SlackResponse:
+    return client.chat_startStream(
+        channel=context.channel_id,
+        thread_ts=thread_ts,
+        markdown_text=markdown_text,
+        recipient_team_id=context.team_id or context.enterprise_id,
+        recipient_user_id=user,
+    )
+
+
+def stop_streaming_reply(
+    *,
+    client: WebClient,
+    channel: str,
+    ts: str,
+    markdown_text: Optional[str],
+    messages: List[Dict[str, str]],
+    user: str,
+) -> SlackResponse:
+    system_messages = [msg for msg in messages if msg["role"] == "system"]
+    return client.chat_stopStream(
+        channel=channel,
+        ts=ts,
+        markdown_text=markdown_text,
+        metadata={
+            "event_type": "chat-gpt-convo",
+            "event_payload": {"messages": system_messages, "user": user},
+        },
+    )
+
+
 def update_wip_message(
     client: WebClient,
     channel: str,
@@ -97,9 +381,14 @@ def update_wip_message(
     text: str,
     messages: List[Dict[str, str]],
     user: str,
+    retries: Optional[int] = None,
 ) -> SlackResponse:
     system_messages = [msg for msg in messages if msg["role"] == "system"]
-    return client.chat_update(
+    if retries is None:
+        retries = SLACK_RATE_LIMIT_RETRIES
+    # A reply can be updated many times in a short period,
+    # so losing one of the updates to rate limiting should not abort the whole reply
+    return _with_rate_limit_retries(client, retries).chat_update(
         channel=channel,
         ts=ts,
         text=text,
@@ -110,6 +399,25 @@ def update_wip_message(
     )
 
 
+def _with_rate_limit_retries(client: WebClient, max_retry_count: int) -> WebClient:
+    # The client's own RateLimitErrorRetryHandler is replaced instead of wrapped,
+    # so the number of chat.update calls never exceeds 1 + max_retry_count
+    if not isinstance(client, WebClient):
+        return client
+    retry_handlers = [
+        handler
+        for handler in client.retry_handlers
+        if not isinstance(handler, RateLimitErrorRetryHandler)
+    ]
+    if max_retry_count > 0:
+        retry_handlers.append(
+            RateLimitErrorRetryHandler(max_retry_count=max_retry_count)
+        )
+    client = copy.copy(client)
+    client.retry_handlers = retry_handlers
+    return client
+
+
 # ----------------------------
 # Modals
 # ----------------------------
@@ -124,6 +432,42 @@ def extract_state_value(payload: dict, block_id: str, action_id: str = "input")
 # Files
 # ----------------------------
 
+# Reuses the connections to Slack and OpenAI's CDN for downloading files
+_file_download_session = requests.Session()
+_file_download_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        # Downloads are idempotent, so retry them on temporary server-side errors
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+def _download_file(url: str, bot_token: Optional[str]) -> requests.Response:
+    headers = {"Authorization": f"Bearer {bot_token}"} if bot_token else None
+    response = _file_download_session.get(
+        url, headers=headers, timeout=OPENAI_TIMEOUT_SECONDS
+    )
+    # The retries above don't raise errors, so the last error response ends up here
+    if response.status_code != 200:
+        error = f"Request to {url} failed with status code {response.status_code}"
+        if bot_token is None:
+            # Not a Slack file, e.g., an image generated by OpenAI
+            raise requests.HTTPError(error, response=response)
+        raise SlackApiError(error, response)
+    return response
+
+
+def download_file_content(url: str, bot_token: Optional[str] = None) -> bytes:
+    return _download_file(url, bot_token).content
+
 
 def can_send_image_url_to_openai(context: BoltContext) -> bool:
     if IMAGE_FILE_ACCESS_ENABLED is False:
@@ -139,15 +483,28 @@ def can_send_image_url_to_openai(context: BoltContext) -> bool:
     return can_send_image_url
 
 
-def download_slack_image_content(image_url: str, bot_token: str) -> bytes:
-    response = requests.get(
-        image_url,
-        headers={"Authorization": f"Bearer {bot_token}"},
-    )
-    if response.status_code != 200:
-        error = f"Request to {image_url} failed with status code {response.status_code}"
-        raise SlackApiError(error, response)
+def wait_until_file_is_shared(
+    *,
+    client: WebClient,
+    file_id: str,
+    timeout_seconds: int = OPENAI_TIMEOUT_SECONDS,
+) -> None:
+    # A file uploaded by files_upload_v2 is shared asynchronously,
+    # so check it frequently at first and then less often
+    deadline = time.time() + timeout_seconds
+    interval_seconds = 0.2
+    while True:
+        time.sleep(interval_seconds)
+        shares = client.files_info(file=file_id).get("file").get("shares")
+        if shares and len(shares.get("private", [])) > 0:
+            return
+        if time.time() + interval_seconds > deadline:
+            raise TimeoutError()
+        interval_seconds = min(interval_seconds * 2, 2)
+
 
+def download_slack_image_content(image_url: str, bot_token: str) -> bytes:
+    response = _download_file(image_url, bot_token)
     content_type = response.headers["content-type"]
     if content_type.startswith("text/html"):
         error = f"You don't have the permission to download this file: {image_url}"
@@ -530,7 +530,7 @@ def build_proofreading_result_modal(
         if tone_and_voice.get("selected_option")
         else None
     )
-    text = "\n".join(map(lambda s: f">{s}", original_text.split("\n")))
+    text = ">" + original_text.replace("\n", "\n>")
     private_metadata = payload["private_metadata"]
     if tone_and_voice is not None:
         pm = json.loads(payload["private_metadata"])
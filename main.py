@@ -1,5 +1,6 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from slack_bolt import App, BoltContext
 from slack_sdk.web import WebClient
@@ -9,6 +10,7 @@ from app.bolt_listeners import before_authorize, register_listeners
 from app.env import (
     USE_SLACK_LANGUAGE,
     SLACK_APP_LOG_LEVEL,
+    SLACK_APP_LISTENER_MAX_WORKERS,
     OPENAI_MODEL,
     OPENAI_TEMPERATURE,
     OPENAI_API_TYPE,
@@ -19,6 +21,7 @@ from app.env import (
     OPENAI_ORG_ID,
     OPENAI_IMAGE_GENERATION_MODEL,
 )
+from app.slack_ops import use_orjson_for_slack_api_calls
 from app.slack_ui import build_home_tab
 
 
@@ -26,11 +29,18 @@ if __name__ == "__main__":
     from slack_bolt.adapter.socket_mode import SocketModeHandler
 
     logging.basicConfig(level=SLACK_APP_LOG_LEVEL)
+    use_orjson_for_slack_api_calls()
 
     app = App(
         token=os.environ["SLACK_BOT_TOKEN"],
         before_authorize=before_authorize,
         process_before_response=True,
+        # Each conversation holds a thread while receiving OpenAI's streaming response,
+        # so Bolt's default pool (5 threads) easily becomes the bottleneck
+        listener_executor=ThreadPoolExecutor(
+            max_workers=SLACK_APP_LISTENER_MAX_WORKERS,
+            thread_name_prefix="chatgpt-in-slack",
+        ),
     )
     app.client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=2))
 
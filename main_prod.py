@@ -32,6 +32,10 @@ from app.env import (
     OPENAI_ORG_ID,
     OPENAI_IMAGE_GENERATION_MODEL,
 )
+from app.slack_ops import (
+    use_orjson_for_slack_api_calls,
+    disable_thread_caches,
+)
 from app.slack_ui import (
     build_home_tab,
     DEFAULT_HOME_TAB_MESSAGE,
@@ -61,6 +65,11 @@ from slack_bolt.adapter.aws_lambda.lambda_s3_oauth_flow import LambdaS3OAuthFlow
 SlackRequestHandler.clear_all_log_handlers()
 logging.basicConfig(format="%(asctime)s %(message)s", level=SLACK_APP_LOG_LEVEL)
 
+use_orjson_for_slack_api_calls()
+# Message edit/delete events can be delivered to a different Lambda container
+# than the one that cached the thread replies or the parent message's mention
+disable_thread_caches()
+
 s3_client = boto3.client("s3")
 openai_bucket_name = os.environ["OPENAI_S3_BUCKET_NAME"]
 
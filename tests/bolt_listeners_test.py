@@ -0,0 +1,242 @@
+import logging
+import time
+
+import pytest
+from slack_bolt import BoltContext
+from slack_bolt.authorization import AuthorizeResult
+
+import app.bolt_listeners
+import app.openai_ops
+from app.bolt_listeners import respond_to_new_message, before_authorize
+from app.slack_ops import fetch_thread_replies, remember_latest_message_ts
+from tests.openai_stream_fakes import Stream, chunk
+
+
+class ThreadClient:
+    def __init__(self, replies: list):
+        self.replies = replies
+        self.num_posted = 0
+        self.updated_texts = []
+        self.deleted_ts = []
+        self.num_fetches = 0
+
+    def conversations_replies(self, *, ts: str, oldest=None, limit=1000, **kwargs):
+        if kwargs.get("include_all_metadata"):
+            self.num_fetches += 1
+        replies = [self.replies[0]] + [
+            reply
+            for reply in self.replies[1:]
+            if oldest is None or float(reply["ts"]) > float(oldest)
+        ]
+        return {"messages": replies[:limit]}
+
+    def chat_postMessage(self, **kwargs):
+        # The loading message is deleted by the user, so it never shows up in the thread
+        self.num_posted += 1
+        ts = f"{time.time():.0f}.{self.num_posted:06d}"
+        return {"ts": ts, "message": {"ts": ts, "text": kwargs["text"]}}
+
+    def chat_update(self, **kwargs):
+        self.updated_texts.append(kwargs["text"])
+        return {"ts": kwargs["ts"], "message": {"ts": kwargs["ts"]}}
+
+    def chat_delete(self, **kwargs):
+        self.deleted_ts.append(kwargs["ts"])
+
+
+def build_context(channel: str) -> BoltContext:
+    context = BoltContext(
+        {
+            "channel_id": channel,
+            "bot_user_id": "UBOT",
+            "bot_id": "BBOT",
+            "user_id": "U111",
+            "team_id": "T111",
+            "logger": logging.getLogger(__name__),
+            "authorize_result": AuthorizeResult(
+                enterprise_id=None,
+                team_id="T111",
+                bot_user_id="UBOT",
+                bot_id="BBOT",
+                bot_token="xoxb-",
+                bot_scopes=["chat:write"],
+            ),
+        }
+    )
+    for key, value in {
+        "OPENAI_API_KEY": "sk-",
+        "OPENAI_MODEL": "gpt-4o",
+        "OPENAI_TEMPERATURE": 1,
+        "OPENAI_API_TYPE": None,
+        "OPENAI_API_BASE": None,
+        "OPENAI_API_VERSION": None,
+        "OPENAI_DEPLOYMENT_ID": None,
+        "OPENAI_ORG_ID": None,
+        "OPENAI_FUNCTION_CALL_MODULE_NAME": None,
+    }.items():
+        context[key] = value
+    return context
+
+
+@pytest.fixture
+def prompts(monkeypatch):
+    prompts = []
+
+    def start_receiving_openai_response(*, messages, **kwargs):
+        prompts.append(list(messages))
+        return Stream([chunk("Sure!"), chunk(finish_reason="stop")])
+
+    monkeypatch.setattr(app.bolt_listeners, "REPLY_DEBOUNCE_MS", 0)
+    monkeypatch.setattr(
+        app.bolt_listeners,
+        "start_receiving_openai_response",
+        start_receiving_openai_response,
+    )
+    monkeypatch.setattr(
+        app.openai_ops,
+        "calculate_num_tokens",
+        lambda messages, model=None: 10 * len(messages),
+    )
+    return prompts
+
+
+def test_respond_to_new_message_does_not_modify_cached_replies(prompts):
+    # All the replies are old enough to be kept in the thread replies cache
+    base_ts = time.time() - 3600
+    parent = {"ts": f"{base_ts:.6f}", "text": "<@UBOT> Hi!", "user": "U111"}
+    bot_reply = {
+        "ts": f"{base_ts + 1:.6f}",
+        "text": "Hi there!",
+        "user": "UBOT",
+        "bot_id": "BBOT",
+        "metadata": {
+            "event_type": "chat-gpt-convo",
+            "event_payload": {
+                "messages": [{"role": "system", "content": "You are a bot."}],
+                "user": "U111",
+            },
+        },
+    }
+    client = ThreadClient([parent, bot_reply])
+    for turn in range(3):
+        reply = {
+            "ts": f"{base_ts + 2 + turn:.6f}",
+            "text": f"Question {turn}",
+            "user": "U111",
+            "thread_ts": parent["ts"],
+        }
+        client.replies.append(reply)
+        respond_to_new_message(
+            context=build_context("C_CACHED_THREAD"),
+            payload={**reply, "channel_type": "channel"},
+            client=client,
+            logger=logging.getLogger(__name__),
+        )
+
+    # system + parent + bot reply + the questions so far
+    assert [len(prompt) for prompt in prompts] == [4, 5, 6]
+    assert prompts[2][1]["content"][0]["text"] == "<@U111>: Hi!"
+    assert parent["text"] == "<@UBOT> Hi!"
+    assert len(bot_reply["metadata"]["event_payload"]["messages"]) == 1
+
+
+def reply_in_thread(channel: str, parent: dict, text: str, ts: str) -> dict:
+    return {
+        "ts": ts,
+        "text": text,
+        "user": "U111",
+        "thread_ts": parent["ts"],
+        "channel": channel,
+        "channel_type": "channel",
+    }
+
+
+def respond(client: ThreadClient, payload: dict):
+    respond_to_new_message(
+        context=build_context(payload["channel"]),
+        payload=payload,
+        client=client,
+        logger=logging.getLogger(__name__),
+    )
+
+
+def test_respond_to_new_message_skips_debounced_messages(prompts, monkeypatch):
+    monkeypatch.setattr(app.bolt_listeners, "REPLY_DEBOUNCE_MS", 10)
+    parent = {"ts": f"{time.time() - 10:.6f}", "text": "<@UBOT> Hi!", "user": "U111"}
+    client = ThreadClient([parent])
+    older = reply_in_thread("C_DEBOUNCE", parent, "Question", f"{time.time():.6f}")
+    newer = reply_in_thread("C_DEBOUNCE", parent, "Typo", f"{time.time() + 1:.6f}")
+    # The newer message has arrived while the older one is waiting
+    remember_latest_message_ts("C_DEBOUNCE", parent["ts"], newer["ts"])
+
+    respond(client, older)
+    # The older message doesn't even fetch the thread
+    assert client.num_fetches == 0
+    assert prompts == []
+    assert client.num_posted == 0
+
+    respond(client, newer)
+    assert len(prompts) == 1
+    assert client.updated_texts[-1] == "Sure!"
+
+
+def test_respond_to_new_message_replies_without_newer_messages(prompts):
+    parent = {"ts": f"{time.time() - 10:.6f}", "text": "<@UBOT> Hi!", "user": "U111"}
+    client = ThreadClient([parent])
+    respond(client, reply_in_thread("C_NO_NEWER", parent, "Hi", f"{time.time():.6f}"))
+    assert len(prompts) == 1
+    assert client.deleted_ts == []
+    assert client.updated_texts[-1] == "Sure!"
+
+
+def test_respond_to_new_message_drops_superseded_replies(prompts, monkeypatch):
+    parent = {"ts": f"{time.time() - 10:.6f}", "text": "<@UBOT> Hi!", "user": "U111"}
+    client = ThreadClient([parent])
+    older = reply_in_thread("C_SUPERSEDED", parent, "Question", f"{time.time():.6f}")
+
+    def start_receiving_openai_response(*, messages, **kwargs):
+        # The newer message arrives while OpenAI is working on the older one
+        remember_latest_message_ts(
+            "C_SUPERSEDED", parent["ts"], f"{float(older['ts']) + 1:.6f}"
+        )
+        return Stream([chunk("Sure!"), chunk(finish_reason="stop")])
+
+    monkeypatch.setattr(
+        app.bolt_listeners,
+        "start_receiving_openai_response",
+        start_receiving_openai_response,
+    )
+    respond(client, older)
+    # The loading message is deleted without writing the reply
+    assert len(client.deleted_ts) == 1
+    assert client.updated_texts == []
+
+
+def test_before_authorize_forgets_deleted_parent_messages():
+    parent_ts = f"{time.time() - 3600:.6f}"
+    client = ThreadClient([{"ts": parent_ts, "text": "Hi!", "user": "U111"}])
+    fetch_thread_replies(client=client, channel="C_DELETED", thread_ts=parent_ts)
+
+    payload = {
+        "type": "message",
+        "subtype": "message_deleted",
+        "channel": "C_DELETED",
+        "ts": f"{time.time():.6f}",
+        "deleted_ts": parent_ts,
+        "hidden": True,
+    }
+    response = before_authorize(
+        context=build_context("C_DELETED"),
+        body={"type": "event_callback", "event": payload},
+        payload=payload,
+        logger=logging.getLogger(__name__),
+        next_=lambda: None,
+    )
+    assert response.status == 200
+
+    # The cached parent message is not used anymore
+    client.replies[0] = {"ts": parent_ts, "text": "This message was deleted."}
+    replies = fetch_thread_replies(
+        client=client, channel="C_DELETED", thread_ts=parent_ts
+    )
+    assert replies[0]["text"] == "This message was deleted."
@@ -0,0 +1,82 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from slack_bolt import BoltContext
+
+import app.i18n
+from app.i18n import translate
+
+
+class TranslationClient:
+    def __init__(self, on_create):
+        self.texts = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.on_create = on_create
+
+    def create(self, *, messages, **kwargs):
+        text = messages[-1]["content"].split("\n")[-1]
+        self.texts.append(text)
+        self.on_create(text)
+        content = f"{text} (ja)"
+        return SimpleNamespace(
+            model_dump=lambda: {"choices": [{"message": {"content": content}}]}
+        )
+
+
+def translate_in_threads(texts):
+    context = BoltContext({"locale": "ja-JP"})
+    results = {}
+
+    def run(i, text):
+        results[i] = translate(openai_api_key="sk-", context=context, text=text)
+
+    threads = [
+        threading.Thread(target=run, args=(i, text)) for i, text in enumerate(texts)
+    ]
+    for t in threads:
+        t.start()
+    return threads, results
+
+
+def test_translate_calls_openai_once_for_the_same_text(monkeypatch):
+    all_started = threading.Event()
+    client = TranslationClient(on_create=lambda text: all_started.wait(timeout=5))
+    monkeypatch.setattr(app.i18n, "build_openai_client", lambda **kwargs: client)
+
+    threads, results = translate_in_threads(["Loading ..."] * 8)
+    # Let the other threads reach the cache miss while the first one is calling OpenAI
+    time.sleep(0.1)
+    all_started.set()
+    for t in threads:
+        t.join(timeout=5)
+
+    assert client.texts == ["Loading ..."]
+    assert list(results.values()) == ["Loading ... (ja)"] * 8
+
+
+def test_translate_does_not_block_other_texts(monkeypatch):
+    first_text_called = threading.Event()
+    other_text_called = threading.Event()
+    observed = []
+
+    def on_create(text):
+        if text == "Hello":
+            first_text_called.set()
+            # This waits for the other translation, which must not wait for this one
+            observed.append(other_text_called.wait(timeout=5))
+        else:
+            other_text_called.set()
+
+    client = TranslationClient(on_create=on_create)
+    monkeypatch.setattr(app.i18n, "build_openai_client", lambda **kwargs: client)
+
+    threads, results = translate_in_threads(["Hello"])
+    first_text_called.wait(timeout=5)
+    threads2, results2 = translate_in_threads(["Goodbye"])
+    for t in threads + threads2:
+        t.join(timeout=5)
+
+    assert observed == [True]
+    assert results == {0: "Hello (ja)"}
+    assert results2 == {0: "Goodbye (ja)"}
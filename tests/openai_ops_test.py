@@ -1,7 +1,18 @@
+from types import SimpleNamespace
+
+import pytest
+from slack_bolt import BoltContext
+
+import app.openai_ops
 from app.openai_ops import (
+    build_system_text,
+    consume_openai_stream_to_write_reply,
+    calculate_num_tokens,
+    messages_within_context_window,
     format_assistant_reply,
     format_openai_message_content,
 )
+from tests.openai_stream_fakes import chunk
 
 
 def test_format_assistant_reply():
@@ -69,3 +80,225 @@ int main(int argc, char *argv[])
     ]:
         result = format_openai_message_content(content, False)
         assert result == expected
+
+
+def test_build_system_text():
+    template = "Your Slack user ID is <@{bot_user_id}>. Format bold text *like this*."
+    for bot_user_id, translate_markdown, expected in [
+        (
+            "U111",
+            False,
+            "Your Slack user ID is <@U111>. Format bold text *like this*.",
+        ),
+        (
+            "U222",
+            True,
+            "Your Slack user ID is <@U222>. Format bold text **like this**.",
+        ),
+        # The cached result with markdown translation must not be reused here
+        (
+            "U222",
+            False,
+            "Your Slack user ID is <@U222>. Format bold text *like this*.",
+        ),
+    ]:
+        context = BoltContext({"bot_user_id": bot_user_id})
+        result = build_system_text(template, translate_markdown, context)
+        assert result == expected
+
+
+class StreamClient:
+    def __init__(self):
+        self.calls = []
+
+    def chat_startStream(self, **kwargs):
+        self.calls.append(("chat_startStream", kwargs.get("markdown_text")))
+        return {"ts": "111.333"}
+
+    def chat_appendStream(self, **kwargs):
+        self.calls.append(("chat_appendStream", kwargs.get("markdown_text")))
+
+    def chat_stopStream(self, **kwargs):
+        self.calls.append(("chat_stopStream", kwargs.get("markdown_text")))
+
+    def chat_delete(self, **kwargs):
+        self.calls.append(("chat_delete", kwargs.get("ts")))
+
+    def chat_update(self, **kwargs):
+        self.calls.append(("chat_update", kwargs.get("text")))
+
+
+def consume_stream(client, stream):
+    consume_openai_stream_to_write_reply(
+        client=client,
+        wip_reply={"message": {"ts": "111.222", "thread_ts": "111.111"}},
+        context=BoltContext({"channel_id": "C111", "team_id": "T111"}),
+        user_id="U111",
+        messages=[{"role": "system", "content": "You are a bot."}],
+        stream=stream,
+        timeout_seconds=30,
+        translate_markdown=False,
+    )
+
+
+@pytest.fixture
+def chat_stream(monkeypatch):
+    monkeypatch.setattr(app.openai_ops, "SLACK_CHAT_STREAM_ENABLED", True)
+    monkeypatch.setattr(app.openai_ops, "STREAM_FLUSH_CHARS", 1)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.openai_ops, "time", SimpleNamespace(time=lambda: now[0]))
+    monkeypatch.setattr(app.openai_ops, "SLACK_CHAT_STREAM_ENABLED", False)
+    monkeypatch.setattr(app.openai_ops, "STREAM_FLUSH_MS", 1000)
+    monkeypatch.setattr(app.openai_ops, "STREAM_FLUSH_CHARS", 400)
+    return now
+
+
+def timed_stream(clock, timed_contents):
+    start_time = clock[0]
+    for seconds, content in timed_contents:
+        clock[0] = start_time + seconds
+        yield chunk(content)
+    yield chunk(finish_reason="stop")
+
+
+def test_consume_stream_flushes_after_flush_ms(clock):
+    client = StreamClient()
+    consume_stream(
+        client,
+        timed_stream(
+            clock,
+            [(1.2, "Hel"), (2.1, "lo"), (2.2, "!"), (2.5, " Bye")],
+        ),
+    )
+    # The time limit counts from the first delta, not from the OpenAI request
+    assert client.calls == [
+        ("chat_update", "Hello! ... :writing_hand:"),
+        ("chat_update", "Hello! Bye"),
+    ]
+
+
+def test_consume_stream_flushes_after_flush_chars(clock, monkeypatch):
+    monkeypatch.setattr(app.openai_ops, "STREAM_FLUSH_CHARS", 5)
+    client = StreamClient()
+    consume_stream(
+        client,
+        timed_stream(clock, [(0.1, "abcd"), (0.2, "e"), (0.3, "f")]),
+    )
+    assert client.calls == [
+        ("chat_update", "abcde ... :writing_hand:"),
+        ("chat_update", "abcdef"),
+    ]
+
+
+def test_consume_stream_with_chat_stream(chat_stream):
+    client = StreamClient()
+    consume_stream(
+        client,
+        [
+            chunk("```python\n"),
+            chunk("print(1)\n"),
+            chunk("```"),
+            chunk(" Done"),
+            chunk(finish_reason="stop"),
+        ],
+    )
+    # Every part is formatted the same way as the text in chat.update
+    assert client.calls == [
+        ("chat_startStream", "```\n"),
+        ("chat_delete", "111.222"),
+        ("chat_appendStream", "print(1)\n"),
+        ("chat_stopStream", "``` Done"),
+    ]
+
+
+def test_consume_stream_holds_back_the_mention_prefix(chat_stream):
+    client = StreamClient()
+    consume_stream(
+        client,
+        [
+            chunk("<@U"),
+            chunk("BOT>"),
+            chunk(": Hel"),
+            chunk("lo"),
+            chunk(" world"),
+            chunk(finish_reason="stop"),
+        ],
+    )
+    assert client.calls == [
+        ("chat_startStream", "Hel"),
+        ("chat_delete", "111.222"),
+        ("chat_appendStream", "lo"),
+        ("chat_appendStream", " world"),
+        ("chat_stopStream", None),
+    ]
+
+
+def test_consume_stream_replaces_diverged_chat_stream(chat_stream):
+    client = StreamClient()
+    consume_stream(
+        client,
+        [
+            chunk("<@U111> said "),
+            chunk("<@U222>: OK"),
+            chunk("!"),
+            chunk(finish_reason="stop"),
+        ],
+    )
+    # The mention prefix is removed only after the first part has been streamed
+    assert client.calls == [
+        ("chat_startStream", "<@U111> said "),
+        ("chat_delete", "111.222"),
+        ("chat_stopStream", None),
+        ("chat_update", "OK!"),
+    ]
+
+
+def test_consume_stream_stops_chat_stream_on_errors(chat_stream):
+    def stream():
+        yield chunk("Hello")
+        raise ConnectionError()
+
+    client = StreamClient()
+    with pytest.raises(ConnectionError):
+        consume_stream(client, stream())
+    assert client.calls == [
+        ("chat_startStream", "Hello"),
+        ("chat_delete", "111.222"),
+        ("chat_stopStream", None),
+    ]
+
+
+def test_messages_within_context_window_keeps_the_token_count(monkeypatch):
+    # Counts words instead of tokens so that this test doesn't download the tiktoken data
+    encoding = SimpleNamespace(name="test_whitespace", encode=lambda text: text.split())
+    monkeypatch.setattr(
+        app.openai_ops.tiktoken, "encoding_for_model", lambda model: encoding
+    )
+    monkeypatch.setattr(app.openai_ops.tiktoken, "get_encoding", lambda name: encoding)
+    context = BoltContext({"OPENAI_MODEL": "gpt-3.5-turbo"})
+    messages = [{"role": "system", "content": "You are a bot."}] + [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": "word " * (1000 * (i + 1)),
+            **({"name": "U111"} if i % 2 == 0 else {}),
+        }
+        for i in range(8)
+    ]
+
+    # Trim the same messages, counting all of the remaining ones every time
+    expected = list(messages)
+    _, _, max_context_tokens = messages_within_context_window([], context)
+    while calculate_num_tokens(expected) > max_context_tokens:
+        del expected[1]
+
+    trimmed, num_context_tokens, _ = messages_within_context_window(
+        list(messages), context
+    )
+    assert len(trimmed) < len(messages)
+    assert trimmed == expected
+    # The running total after removing messages matches a fresh count
+    assert num_context_tokens == calculate_num_tokens(trimmed)
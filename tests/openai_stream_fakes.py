@@ -0,0 +1,11 @@
+from types import SimpleNamespace
+
+
+class Stream(list):
+    def close(self):
+        pass
+
+
+def chunk(content=None, finish_reason=None):
+    item = {"delta": {"content": content}, "finish_reason": finish_reason}
+    return SimpleNamespace(choices=[SimpleNamespace(model_dump=lambda: item)])
@@ -0,0 +1,290 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+from slack_bolt import BoltContext
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry import builtin_handlers
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from slack_sdk.web import WebClient
+
+import app.slack_ops
+from app.slack_ops import (
+    update_wip_message,
+    fetch_thread_replies,
+    use_orjson_for_slack_api_calls,
+    is_this_app_thread,
+    remember_this_app_thread,
+    forget_changed_thread_message,
+    open_dm,
+    wait_until_file_is_shared,
+    download_file_content,
+)
+
+
+class RateLimitedClient(WebClient):
+    # The client that Bolt passes to listeners already retries rate-limited calls twice
+    def __init__(self, num_failures: int):
+        super().__init__(
+            token="xoxb-",
+            retry_handlers=[RateLimitErrorRetryHandler(max_retry_count=2)],
+        )
+        self.num_failures = num_failures
+        # Shared with the copies of this client
+        self.urls = []
+
+    def _perform_urllib_http_request_internal(self, url, req):
+        self.urls.append(url)
+        if len(self.urls) <= self.num_failures:
+            return {
+                "status": 429,
+                "headers": {"Retry-After": ["0"]},
+                "body": '{"ok": false, "error": "ratelimited"}',
+            }
+        return {"status": 200, "headers": {}, "body": '{"ok": true}'}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(builtin_handlers.time, "sleep", lambda seconds: None)
+
+
+def test_update_wip_message_retries_rate_limited_calls():
+    client = RateLimitedClient(num_failures=3)
+    response = update_wip_message(
+        client=client,
+        channel="C111",
+        ts="111.222",
+        text="Hi there!",
+        messages=[{"role": "system", "content": "You are a bot."}],
+        user="U111",
+    )
+    assert response.status_code == 200
+    assert len(client.urls) == 4
+
+
+def test_update_wip_message_gives_up_after_retries(monkeypatch):
+    monkeypatch.setattr(app.slack_ops, "SLACK_RATE_LIMIT_RETRIES", 1)
+    client = RateLimitedClient(num_failures=5)
+    with pytest.raises(SlackApiError):
+        update_wip_message(
+            client=client,
+            channel="C111",
+            ts="111.222",
+            text="Hi there!",
+            messages=[],
+            user="U111",
+        )
+    # The client's own retries are not added on top of SLACK_RATE_LIMIT_RETRIES
+    assert len(client.urls) == 2
+
+
+def test_update_wip_message_without_retries():
+    client = RateLimitedClient(num_failures=1)
+    with pytest.raises(SlackApiError):
+        update_wip_message(
+            client=client,
+            channel="C111",
+            ts="111.222",
+            text="Hi there!",
+            messages=[],
+            user="U111",
+            retries=0,
+        )
+    assert len(client.urls) == 1
+
+
+class ThreadClient:
+    def __init__(self, replies: list):
+        self.replies = replies
+        self.oldest_values = []
+
+    def conversations_replies(self, **kwargs):
+        oldest = kwargs.get("oldest")
+        self.oldest_values.append(oldest)
+        messages = [
+            reply
+            for reply in self.replies
+            if oldest is None or float(reply["ts"]) >= float(oldest)
+        ]
+        return {"messages": messages}
+
+
+def test_fetch_thread_replies_fetches_only_new_replies():
+    old_ts = f"{time.time() - 3600:.6f}"
+    settled_reply_ts = f"{time.time() - 3000:.6f}"
+    client = ThreadClient(
+        [{"ts": old_ts, "text": "Hi!"}, {"ts": settled_reply_ts, "text": "Hello!"}]
+    )
+    replies = fetch_thread_replies(client=client, channel="C111", thread_ts=old_ts)
+    assert len(replies) == 2
+
+    new_reply_ts = f"{time.time():.6f}"
+    client.replies.append({"ts": new_reply_ts, "text": "How are you?"})
+    replies = fetch_thread_replies(client=client, channel="C111", thread_ts=old_ts)
+    assert [r["ts"] for r in replies] == [old_ts, settled_reply_ts, new_reply_ts]
+    # The recent reply is not cached because it still can be updated
+    replies = fetch_thread_replies(client=client, channel="C111", thread_ts=old_ts)
+    assert len(replies) == 3
+    assert client.oldest_values == [None, settled_reply_ts, settled_reply_ts]
+
+
+def test_thread_caches_disabled(monkeypatch):
+    monkeypatch.setattr(app.slack_ops, "_thread_caches_enabled", True)
+    app.slack_ops.disable_thread_caches()
+    old_ts = f"{time.time() - 3600:.6f}"
+    client = ThreadClient([{"ts": old_ts, "text": "Hi!"}])
+    fetch_thread_replies(client=client, channel="C_NO_CACHE", thread_ts=old_ts)
+    fetch_thread_replies(client=client, channel="C_NO_CACHE", thread_ts=old_ts)
+    assert client.oldest_values == [None, None]
+
+    context = BoltContext({"bot_user_id": "UBOT"})
+    remember_this_app_thread(context, "C_NO_CACHE", old_ts, True)
+    assert (
+        is_this_app_thread(
+            context=context, client=client, channel="C_NO_CACHE", thread_ts=old_ts
+        )
+        is False
+    )
+
+
+def test_use_orjson_for_slack_api_calls(monkeypatch):
+    from slack_sdk.web import base_client
+
+    monkeypatch.setattr(base_client, "json", base_client.json)
+    use_orjson_for_slack_api_calls()
+    assert base_client.json.loads('{"ok": true}') == {"ok": True}
+    assert base_client.json.dumps({"ok": True}) == '{"ok":true}'
+    assert base_client.json.dumps({1: "a"}) == '{"1": "a"}'
+    assert base_client.json.decoder.JSONDecodeError is not None
+
+
+def test_is_this_app_thread_remembers_the_result():
+    context = BoltContext({"bot_user_id": "UBOT"})
+    client = ThreadClient([{"ts": "111.222", "text": "Hi there!"}])
+    for _ in range(2):
+        assert (
+            is_this_app_thread(
+                context=context, client=client, channel="C222", thread_ts="111.222"
+            )
+            is False
+        )
+    assert client.oldest_values == [None]
+
+    remember_this_app_thread(context, "C222", "111.222", True)
+    assert is_this_app_thread(
+        context=context, client=client, channel="C222", thread_ts="111.222"
+    )
+    # The same Slack Connect channel in another workspace is checked separately
+    other_context = BoltContext({"bot_user_id": "UBOT2", "team_id": "T222"})
+    assert (
+        is_this_app_thread(
+            context=other_context, client=client, channel="C222", thread_ts="111.222"
+        )
+        is False
+    )
+    assert client.oldest_values == [None, None]
+
+
+def test_forget_changed_thread_message():
+    old_ts = f"{time.time() - 3600:.6f}"
+    client = ThreadClient([{"ts": old_ts, "text": "Hi!"}])
+    fetch_thread_replies(client=client, channel="C333", thread_ts=old_ts)
+    fetch_thread_replies(client=client, channel="C333", thread_ts=old_ts)
+    assert client.oldest_values == [None, old_ts]
+
+    forget_changed_thread_message(
+        BoltContext(), "C333", {"ts": old_ts, "text": "Hi there!"}
+    )
+    fetch_thread_replies(client=client, channel="C333", thread_ts=old_ts)
+    assert client.oldest_values == [None, old_ts, None]
+
+
+def test_forget_changed_thread_message_during_fetch():
+    old_ts = f"{time.time() - 3600:.6f}"
+
+    class EditedThreadClient(ThreadClient):
+        def conversations_replies(self, **kwargs):
+            replies = super().conversations_replies(**kwargs)
+            # The message is edited after Slack has returned the old text
+            self.replies = [{"ts": old_ts, "text": "Hi there!"}]
+            forget_changed_thread_message(BoltContext(), "C444", self.replies[0])
+            return replies
+
+    client = EditedThreadClient([{"ts": old_ts, "text": "Hi!"}])
+    fetch_thread_replies(client=client, channel="C444", thread_ts=old_ts)
+    # The replies fetched before the change are not cached
+    replies = fetch_thread_replies(client=client, channel="C444", thread_ts=old_ts)
+    assert client.oldest_values == [None, None]
+    assert replies[0]["text"] == "Hi there!"
+
+
+class FilesClient:
+    def __init__(self, num_unshared_calls: int):
+        self.num_unshared_calls = num_unshared_calls
+        self.num_calls = 0
+
+    def files_info(self, **kwargs):
+        self.num_calls += 1
+        if self.num_calls <= self.num_unshared_calls:
+            return {"file": {"shares": {}}}
+        return {"file": {"shares": {"private": {"D111": [{"ts": "111.222"}]}}}}
+
+
+def test_wait_until_file_is_shared(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(app.slack_ops.time, "sleep", sleeps.append)
+    client = FilesClient(num_unshared_calls=3)
+    wait_until_file_is_shared(client=client, file_id="F111")
+    assert client.num_calls == 4
+    assert sleeps == [0.2, 0.4, 0.8, 1.6]
+
+    with pytest.raises(TimeoutError):
+        wait_until_file_is_shared(
+            client=FilesClient(num_unshared_calls=100),
+            file_id="F111",
+            timeout_seconds=0,
+        )
+
+
+class DMClient:
+    def __init__(self):
+        self.opened_users = []
+
+    def conversations_open(self, *, users):
+        self.opened_users.append(users)
+        return {"channel": {"id": f"D{users[0]}"}}
+
+
+def test_open_dm_remembers_the_channel_id():
+    context = BoltContext({"team_id": "T111"})
+    client = DMClient()
+    for _ in range(2):
+        assert open_dm(context=context, client=client, user_id="U111") == "DU111"
+    assert client.opened_users == [["U111"]]
+
+
+def test_bounded_lru_cache():
+    cache = app.slack_ops._BoundedLRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.update("a", lambda value: value + 1)
+    cache.set("c", 3)
+    # "b" is the least recently updated one
+    assert [cache.get(key) for key in ["a", "b", "c"]] == [2, None, 3]
+
+    cache.update("a", lambda value: None)
+    cache.pop("c")
+    assert [cache.get(key) for key in ["a", "c"]] == [None, None]
+
+
+def test_download_file_content_fails_on_error_responses(monkeypatch):
+    response = SimpleNamespace(status_code=503, headers={}, content=b"Unavailable")
+    monkeypatch.setattr(
+        app.slack_ops._file_download_session, "get", lambda url, **kwargs: response
+    )
+    with pytest.raises(requests.HTTPError):
+        download_file_content("https://files.example.com/image.png")
+    with pytest.raises(SlackApiError):
+        download_file_content("https://files.slack.com/image.png", "xoxb-")